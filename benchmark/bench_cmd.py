@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+"""
+加载器、帮助组装与运行的规模基准测试。
+
+生成包含指定数量 _cmd.py 的临时命令包，测量 ModuleFileCmdLoader.load()、DefaultCmdHelper.assemble()、usage()、
+参数解析器编译与解析、run_all()（以及开启执行指标时）的耗时、执行指标的每次记录开销（指标自身统计的，以及开启前后分派耗时之差）以及峰值内存，结果以 json 输出，并可与保存的基准结果比较，超出容差的指标视为退化。
+
+    $> python3 benchmark/bench_cmd.py --sizes 10,1000 --output result.json
+    $> python3 benchmark/bench_cmd.py --save-baseline benchmark/baseline.json
+    $> python3 benchmark/bench_cmd.py --baseline benchmark/baseline.json --tolerance 0.2
+"""
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util import cmd_loader as cmd_loader_module  # noqa: E402
+from util.cmd_helper import DefaultCmdHelper  # noqa: E402
+from util.cmd_loader import DirIndex, ModuleFileCmdLoader  # noqa: E402
+from util.cmd_metrics import CmdMetrics  # noqa: E402
+
+DEFAULT_SIZES = '10,1000,10000'
+PACKAGE_PREFIX = 'bench_cmd_pkg_'
+DISPATCH_CALLS = 1000
+CMD_TEMPLATE = '''from command import Cmd, CmdArg
+
+
+class {class_name}(Cmd):
+
+    def __init__(self):
+        super().__init__()
+{add_args}
+
+    def name(self):
+        return '{name}'
+
+    def exec(self, short_arg, long_arg, value):
+        return 0
+'''
+ADD_ARG_TEMPLATE = "        self.add_arg('a{idx}', CmdArg('-{short}', '--opt{idx}', {need_value}, 'Option {idx} of {name}.'))"
+SHORT_NAMES = 'abcdefgijklmnopq'
+
+
+def generate_package(root, size):
+    """
+    生成包含 size 个子命令的命令包，第 i 个子命令有 i % 8 + 1 个参数
+
+    :return: (包名, 包目录)
+    """
+    package = '%s%d' % (PACKAGE_PREFIX, size)
+    package_dir = os.path.join(root, package)
+    os.makedirs(package_dir)
+    open(os.path.join(package_dir, '__init__.py'), 'w').close()
+    for i in range(size):
+        name = 'c%d' % i
+        add_args = '\n'.join(ADD_ARG_TEMPLATE.format(idx=j, short=SHORT_NAMES[j], need_value=j % 2 == 1, name=name)
+                             for j in range(i % 8 + 1))
+        with open(os.path.join(package_dir, name + '_cmd.py'), 'w') as f:
+            f.write(CMD_TEMPLATE.format(class_name='C%dCmd' % i, name=name, add_args=add_args))
+    return package, package_dir
+
+
+def purge(package):
+    """
+    移除已加载的命令模块和进程内的目录索引，使下一次加载与冷启动一致
+    """
+    for module_name in [m for m in sys.modules if m.startswith(package + '.')]:
+        del sys.modules[module_name]
+    importlib.invalidate_caches()
+    cmd_loader_module.dir_index = DirIndex()
+
+
+def new_loader(package, package_dir, lazy=False, manifest_file=None):
+    loader = ModuleFileCmdLoader().set_module_name(package).set_cmd_dir(package_dir).set_lazy(lazy)
+    if manifest_file:
+        loader.set_manifest_file(manifest_file)
+    return loader
+
+
+def best_of(repeat, func, setup=None):
+    """
+    重复执行并返回最短耗时，setup 的耗时不计入
+    """
+    best = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_size(root, size, repeat):
+    package, package_dir = generate_package(root, size)
+    manifest_file = os.path.join(root, package + '.json')
+    names = ['c%d' % i for i in range(size)]
+    result = {}
+
+    # 预热，生成字节码缓存
+    new_loader(package, package_dir).load()
+
+    result['load_eager'] = best_of(repeat, lambda: new_loader(package, package_dir).load(),
+                                   lambda: purge(package))
+    result['load_lazy'] = best_of(repeat, lambda: new_loader(package, package_dir, lazy=True).load(),
+                                  lambda: purge(package))
+    new_loader(package, package_dir, lazy=True, manifest_file=manifest_file).load()
+    result['load_manifest'] = best_of(
+        repeat, lambda: new_loader(package, package_dir, lazy=True, manifest_file=manifest_file).load(),
+        lambda: purge(package))
+
+    # 以下均在模块已加载到 sys.modules 的情况下测量，不包含加载模块的耗时
+    loaded = new_loader(package, package_dir).load()
+    helpers = []
+
+    def new_helper():
+        helpers[:] = [DefaultCmdHelper().set_cmd_loader(loaded)]
+
+    result['assemble'] = best_of(repeat, lambda: helpers[0].assemble(), new_helper)
+
+    def usage():
+        with contextlib.redirect_stdout(io.StringIO()):
+            helpers[0].usage()
+
+    def assembled_helper():
+        new_helper()
+        helpers[0].assemble()
+
+    result['usage'] = best_of(repeat, usage, assembled_helper)
+    result['usage_cached'] = best_of(repeat, usage)
+
+    def parsers():
+        for name in names:
+            helpers[0].parser(name)
+
+    result['parsers'] = best_of(repeat, parsers, assembled_helper)
+
+    def parse():
+        for name in names:
+            helpers[0].parser(name).parse(['-a'])
+
+    result['parse'] = best_of(repeat, parse)
+
+    helper = helpers[0]
+    calls = [(names[i % size], [('-a', None)]) for i in range(DISPATCH_CALLS)]
+
+    def dispatch():
+        for sub_cmd, opts in calls:
+            helper.run_all(sub_cmd, opts)
+
+    dispatch()
+    result['dispatch_per_call'] = best_of(repeat, dispatch) / DISPATCH_CALLS
+
+    # 开启执行指标后的分派耗时，以及指标自身统计的每次记录耗时（微秒）
+    metrics = CmdMetrics(os.path.join(root, package + '.prom'))
+    helper.set_metrics(metrics)
+    result['dispatch_per_call_metrics'] = best_of(repeat, dispatch) / DISPATCH_CALLS
+    result['metrics_overhead_us'] = metrics.overhead()
+    result['metrics_dispatch_overhead_us'] = (result['dispatch_per_call_metrics'] - result['dispatch_per_call']) * 1e6
+    helper.set_metrics(None)
+
+    purge(package)
+    tracemalloc.start()
+    helper = DefaultCmdHelper().set_cmd_loader(new_loader(package, package_dir))
+    helper.assemble()
+    usage()
+    result['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    purge(package)
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    与基准结果比较，返回退化的指标
+
+    :return: (规模, 指标, 基准值, 当前值) 的列表
+    """
+    regressions = []
+    for size, metrics in results.items():
+        base_metrics = baseline.get('results', {}).get(size, {})
+        for metric, value in metrics.items():
+            base = base_metrics.get(metric)
+            if base and value > base * (1 + tolerance):
+                regressions.append((size, metric, base, value))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark command loading, help assembly and dispatch.')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='comma separated command counts')
+    parser.add_argument('--repeat', type=int, default=3, help='repeat each measurement and keep the best')
+    parser.add_argument('--output', help='write json results to this file instead of stdout')
+    parser.add_argument('--baseline', help='compare against this baseline json file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown ratio against the baseline')
+    parser.add_argument('--save-baseline', help='save results as the baseline json file')
+    options = parser.parse_args(argv)
+
+    root = tempfile.mkdtemp(prefix='bench_cmd_')
+    sys.path.insert(0, root)
+    try:
+        results = {}
+        for size in [int(s) for s in options.sizes.split(',') if s]:
+            results[str(size)] = bench_size(root, size, options.repeat)
+            print('%6d commands: %s' % (size, ', '.join('%s=%.6g' % kv for kv in results[str(size)].items())),
+                  file=sys.stderr)
+    finally:
+        sys.path.remove(root)
+        shutil.rmtree(root, ignore_errors=True)
+
+    report = {'python': platform.python_version(), 'platform': platform.platform(), 'results': results}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if options.save_baseline:
+        with open(options.save_baseline, 'w') as f:
+            f.write(text + '\n')
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, options.tolerance)
+        for size, metric, base, value in regressions:
+            print('REGRESSION %s commands %s: %.6g -> %.6g' % (size, metric, base, value), file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,16 +1,222 @@
 #!/usr/bin/python3
 # -*- coding: UTF-8 -*-
 import os
+import signal
 import sys
 
-from util.cmd_helper import run_cmd
-from util.cmd_loader import ModuleFileCmdLoader
+BATCH_USAGE = 'cmd.py --batch <file|-> [--jobs <n>]'
+SERVE_USAGE = 'cmd.py --serve [<socket>]'
+CACHE_USAGE = 'cmd.py --cache stats|clear [<sub-command>]'
+COMPLETION_USAGE = 'cmd.py --completion bash|zsh'
+COMPLETION_INDEX = '.cmd_completion_index'
+ZIPAPP_USAGE = 'cmd.py --build-zipapp <output.pyz>'
+REGISTRY_MODULE = 'command._registry'
+METRICS_FILE_ENV = 'CMD_METRICS_FILE'
+
+
+def command_dir():
+    return os.path.join(os.path.abspath(os.path.dirname(__file__)), 'command')
 
-if __name__ == '__main__':
-    current_path = os.path.abspath(os.path.dirname(__file__))
 
+def new_cmd_loader():
+    import importlib.util
+    from util.cmd_loader import ModuleFileCmdLoader, StaticCmdLoader
+
+    # 存在静态注册表（zipapp 打包时生成）时直接使用注册表，无需扫描命令目录
+    if importlib.util.find_spec(REGISTRY_MODULE) is not None:
+        return StaticCmdLoader(REGISTRY_MODULE)
+    cmd_dir = command_dir()
     cmd_loader = ModuleFileCmdLoader()
-    cmd_loader.set_module_name('command').set_cmd_dir(os.path.join(current_path, 'command'))
+    cmd_loader.set_module_name('command').set_cmd_dir(cmd_dir).set_lazy(True) \
+        .set_manifest_file(os.path.join(cmd_dir, '.cmd_manifest.json'))
+    return cmd_loader
+
+
+def new_cmd_helper():
+    from util.cmd_helper import DefaultCmdHelper
+
+    helper = DefaultCmdHelper()
+    # 设置了环境变量 CMD_METRICS_FILE 时记录执行指标，进程退出时写入文件；未设置时不加载指标模块
+    if os.environ.get(METRICS_FILE_ENV):
+        from util.cmd_metrics import metrics_from_env
+        helper.set_metrics(metrics_from_env())
+    return helper
+
+
+def batch(argv):
+    """
+    批量执行：cmd.py --batch <file|-> [--jobs <n>]，每行一条子命令调用，- 表示从标准输入读取，n 为不小于 1 的整数。
+    每行的退出码输出到标准错误，存在失败的行时以第一个非 0 的退出码退出
+    """
+    from util.cmd_helper import run_batch
+
+    workers = 1
+    if len(argv) not in (3, 5) or (len(argv) == 5 and argv[3] != '--jobs'):
+        workers = 0
+    elif len(argv) == 5:
+        try:
+            workers = int(argv[4])
+        except ValueError:
+            workers = 0
+    if workers < 1:
+        print(BATCH_USAGE, file=sys.stderr)
+        return 2
+    if argv[2] == '-':
+        results = run_batch(sys.stdin, new_cmd_loader(), new_cmd_helper(), workers=workers)
+    else:
+        with open(argv[2], 'r', encoding='utf-8') as f:
+            results = run_batch(f, new_cmd_loader(), new_cmd_helper(), workers=workers)
+    exit_code = 0
+    for line, code in results:
+        print('%d\t%s' % (code, line), file=sys.stderr)
+        if code and not exit_code:
+            exit_code = code
+    return exit_code
+
+
+def serve(argv):
+    """
+    守护进程：cmd.py --serve [<socket>]，常驻并通过 Unix 套接字执行其他 cmd.py 进程转发的调用，收到 SIGHUP 时增量重新加载子命令
+    """
+    from util.cmd_server import CmdServer
+
+    if len(argv) > 3:
+        print(SERVE_USAGE, file=sys.stderr)
+        return 2
+    from util.cmd_client import default_socket_path
+
+    # 套接字名由命令目录生成，不同的安装使用各自的守护进程
+    socket_path = argv[2] if len(argv) == 3 else default_socket_path(command_dir())
+    server = CmdServer(new_cmd_loader(), new_cmd_helper(), socket_path=socket_path)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    signal.signal(signal.SIGHUP, lambda signum, frame: server.reload())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def profile(argv):
+    """
+    性能分析：cmd.py --profile <sub-command> <argv>，在当前进程中执行，并将各阶段和各模块的耗时输出到标准错误
+    """
+    from util.cmd_helper import run_cmd
+    from util.cmd_profiler import CmdProfiler
+
+    profiler = CmdProfiler()
+    cmd_loader = new_cmd_loader().set_profiler(profiler)
+    helper = new_cmd_helper().set_profiler(profiler)
+    try:
+        return run_cmd(argv[:1] + argv[2:], cmd_loader, helper)
+    finally:
+        print(profiler.report(), file=sys.stderr)
+
 
-    run_cmd(sys.argv, cmd_loader)
-    pass
+def cache(argv):
+    """
+    结果缓存：cmd.py --cache stats 输出命中与未命中的次数，cmd.py --cache clear [<sub-command>] 使缓存的结果失效
+    """
+    from util.cmd_cache import ResultCache
+
+    if len(argv) < 3 or argv[2] not in ('stats', 'clear') or len(argv) > (4 if argv[2] == 'clear' else 3):
+        print(CACHE_USAGE, file=sys.stderr)
+        return 2
+    result_cache = ResultCache()
+    if argv[2] == 'stats':
+        for name, count in result_cache.stats().items():
+            print('%s\t%d' % (name, count))
+    else:
+        result_cache.invalidate(argv[3] if len(argv) == 4 else None)
+    return 0
+
+
+def completion(argv):
+    """
+    补全脚本：cmd.py --completion bash|zsh 输出补全脚本，如 source <(cmd.py --completion bash)。
+    补全时只读取命令目录中的补全索引，子命令文件有变化时由脚本调用 cmd.py --completion-index 重新生成
+    """
+    from util.cmd_completion import COMPLETION_SHELLS, completion_script
+    from util.cmd_loader import ModuleFileCmdLoader
+
+    if len(argv) != 3 or argv[2] not in COMPLETION_SHELLS:
+        print(COMPLETION_USAGE, file=sys.stderr)
+        return 2
+    cmd_loader = new_cmd_loader()
+    if not isinstance(cmd_loader, ModuleFileCmdLoader):
+        print('Completion is not supported with a static registry', file=sys.stderr)
+        return 2
+    index_file = os.path.join(cmd_loader.cmd_dirs()[0], COMPLETION_INDEX)
+    print(completion_script(argv[2], os.path.abspath(__file__), index_file, cmd_loader.cmd_dirs(),
+                            cmd_loader.file_suffix()))
+    return 0
+
+
+def completion_index(argv):
+    """
+    重新生成补全索引：cmd.py --completion-index，使用清单缓存，只加载修改过的子命令模块
+    """
+    from util.cmd_completion import write_index
+    from util.cmd_loader import ModuleFileCmdLoader
+
+    cmd_loader = new_cmd_loader()
+    if not isinstance(cmd_loader, ModuleFileCmdLoader):
+        print('Completion is not supported with a static registry', file=sys.stderr)
+        return 2
+    cmd_loader.load()
+    write_index(cmd_loader, os.path.join(cmd_loader.cmd_dirs()[0], COMPLETION_INDEX))
+    return 0
+
+
+def build_zipapp(argv):
+    """
+    打包：cmd.py --build-zipapp <output.pyz>，将入口、command 与 util 打包为单个可执行的 zipapp 文件，
+    包中带有预先生成的静态注册表与编译好的字节码，运行时无需扫描命令目录
+    """
+    from util.cmd_loader import ModuleFileCmdLoader
+    from util.cmd_registry import build_zipapp as build
+
+    if len(argv) != 3:
+        print(ZIPAPP_USAGE, file=sys.stderr)
+        return 2
+    cmd_loader = new_cmd_loader()
+    if not isinstance(cmd_loader, ModuleFileCmdLoader):
+        print('Already running from a zipapp', file=sys.stderr)
+        return 2
+    try:
+        count = build(argv[2], os.path.abspath(os.path.dirname(__file__)), cmd_loader)
+    except ValueError as e:
+        print('Can not build %s: %s' % (argv[2], e), file=sys.stderr)
+        return 2
+    print('%s: %d commands' % (argv[2], count), file=sys.stderr)
+    return 0
+
+
+def main(argv):
+    if len(argv) > 1 and argv[1] == '--batch':
+        return batch(argv)
+    if len(argv) > 1 and argv[1] == '--serve':
+        return serve(argv)
+    if len(argv) > 1 and argv[1] == '--profile':
+        return profile(argv)
+    if len(argv) > 1 and argv[1] == '--cache':
+        return cache(argv)
+    if len(argv) > 1 and argv[1] == '--completion':
+        return completion(argv)
+    if len(argv) > 1 and argv[1] == '--completion-index':
+        return completion_index(argv)
+    if len(argv) > 1 and argv[1] == '--build-zipapp':
+        return build_zipapp(argv)
+
+    # 守护进程存在时转发给守护进程执行，否则在当前进程中执行
+    from util.cmd_client import call, default_socket_path
+    code = call(argv, default_socket_path(command_dir()))
+    if code is not None:
+        return code
+
+    from util.cmd_helper import run_cmd
+    return run_cmd(argv, new_cmd_loader(), new_cmd_helper())
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
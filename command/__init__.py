@@ -2,14 +2,21 @@
 
 from abc import ABCMeta, abstractmethod
 from collections import OrderedDict
+from types import MappingProxyType
+
+COALESCE_WAIT = 'wait'  # 相同的调用正在执行时，等待并共享其结果
+COALESCE_SKIP = 'skip'  # 相同的调用正在执行时，直接跳过
 
 
 class CmdArg(object):
     """
-    参数对象，存储了短参名、长参名、是否需要参数值、参数描述
+    参数对象，存储了短参名、长参名、是否需要参数值、参数描述。参数对象创建后不可修改，可以在多个实例之间共享
     """
+    __slots__ = ('short_name', 'long_name', 'need_value', 'description', 'handler', 'concurrent', 'coalesce',
+                 'cache_ttl', 'value_type', 'repeatable')
 
-    def __init__(self, short_name: str, long_name: str, need_value: bool, description: str):
+    def __init__(self, short_name: str, long_name: str, need_value: bool, description: str, handler=None,
+                 concurrent=False, coalesce=None, cache_ttl=None, value_type=None, repeatable=False):
         """
         创建参数对象，存储短参名、长参名、是否需要参数值、参数描述
 
@@ -17,18 +24,132 @@ class CmdArg(object):
         :param long_name: 长参名 (str)
         :param need_value: 是否需要参数值 (bool)
         :param description: 参数描述 (str)
+        :param handler: 参数的处理函数，可以是Cmd实现类中的方法名 (str) 或可调用对象，调用时传入参数值。
+                        为空时使用 arg_handler 装饰的方法，都不存在时由 Cmd.exec 处理
+        :param concurrent: 是否可与同一次调用中的其他参数并发执行 (bool)。默认为 False，即按照命令行中的顺序依次执行
+        :param coalesce: 多个进程同时执行相同的调用（子命令、参数、参数值均相同）时的合并策略，
+                         COALESCE_WAIT 等待正在执行的调用并共享其结果，COALESCE_SKIP 直接跳过；为空时使用 Cmd.cmd_coalesce
+        :param cache_ttl: 结果缓存的有效秒数，只用于查询状态等只读的参数。相同的调用在有效期内直接返回缓存的返回值和输出，
+                          为空时不缓存
+        :param value_type: 参数值的类型或转换函数，如 int、float，解析参数时转换，转换失败时为参数错误。
+                           也可以是 module:qualname 格式的引用字符串，在解析该子命令的参数时才加载所在的模块
+        :param repeatable: 参数是否可重复出现 (bool)。可重复时全部值收集为列表，处理函数只调用一次；不可重复的参数出现多次时为参数错误
         """
-        self.short_name = short_name
-        self.long_name = long_name
-        self.description = description
-        self.need_value = need_value
+        object.__setattr__(self, 'short_name', short_name)
+        object.__setattr__(self, 'long_name', long_name)
+        object.__setattr__(self, 'description', description)
+        object.__setattr__(self, 'need_value', need_value)
+        object.__setattr__(self, 'handler', handler)
+        object.__setattr__(self, 'concurrent', concurrent)
+        object.__setattr__(self, 'coalesce', coalesce)
+        object.__setattr__(self, 'cache_ttl', cache_ttl)
+        object.__setattr__(self, 'value_type', value_type)
+        object.__setattr__(self, 'repeatable', repeatable)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CmdArg is immutable, can't set attribute '%s'" % name)
+
+    def __delattr__(self, name):
+        raise AttributeError("CmdArg is immutable, can't delete attribute '%s'" % name)
+
+    def __reduce__(self):
+        return CmdArg, (self.short_name, self.long_name, self.need_value, self.description, self.handler,
+                        self.concurrent, self.coalesce, self.cache_ttl, self.value_type, self.repeatable)
+
+
+class CmdSchema(object):
+    """
+    子命令的声明式定义，由Cmd实现类中的类属性 cmd_name 和 cmd_args 生成，创建后不可修改。
+    加载器和帮助工具通过 Cmd.schema() 读取子命令名与参数定义，无需创建子命令实例
+    """
+    __slots__ = ('name', 'args')
+
+    def __init__(self, name, args):
+        """
+        创建子命令定义
+
+        :param name: 子命令名
+        :param args: (参数标识符, 参数对象CmdArg) 的序列
+        """
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'args', MappingProxyType(OrderedDict(args)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CmdSchema is immutable, can't set attribute '%s'" % name)
+
+    def arg_tuple(self):
+        """
+        多组参数对象CmdArg
+
+        :return: 多组的参数（元组）
+        """
+        return tuple(self.args.values())
+
+
+def arg_handler(arg_flag):
+    """
+    装饰器，将Cmd实现类中的方法绑定为参数的处理函数。被装饰的方法接收参数值作为唯一的参数，例如：
+
+        @arg_handler('start')
+        def start(self, value):
+            pass
+
+    :param arg_flag: 参数的标识符，即 add_arg 中的 arg_flag
+    """
+    def decorator(func):
+        func.__cmd_arg_flag__ = arg_flag
+        return func
+    return decorator
 
 
 class Cmd(object):
+    """
+    子命令的基类。参数可以在构造方法中通过 add_arg 逐个添加，也可以在类属性中声明，例如：
+
+        class NetworkCmd(Cmd):
+            cmd_name = 'network'
+            cmd_args = (
+                ('start', CmdArg('-s', '--start', False, 'Run service network-manager start.')),
+            )
+
+    声明了 cmd_name 的实现类，加载器无需创建实例即可获取子命令名与参数定义，同一个类的所有实例共享这些参数对象
+    """
     __metaclass__ = ABCMeta
 
+    cmd_name = None     # 子命令名，声明后 name() 默认返回此值
+    cmd_args = ()       # (参数标识符, 参数对象CmdArg) 的元组
+    cmd_coalesce = None     # 参数的默认合并策略，参考 CmdArg 中的 coalesce
+
     def __init__(self):
-        self.__args = OrderedDict()
+        schema = type(self).schema()
+        self.__args = schema.args if schema else OrderedDict()
+        self.__handlers = None
+
+    @classmethod
+    def schema(cls):
+        """
+        获取类属性中声明的子命令定义，只在首次调用时生成
+
+        :return: 子命令定义 CmdSchema，未声明 cmd_name 时返回空
+        """
+        schema = cls.__dict__.get('_Cmd__schema')
+        if schema is None and cls.cmd_name:
+            schema = CmdSchema(cls.cmd_name, cls.cmd_args)
+            cls.__schema = schema
+        return schema
+
+    def __flag_methods(self):
+        """
+        查找使用 arg_handler 装饰的方法
+
+        :return: key为参数标识符，value为绑定的方法
+        """
+        methods = {}
+        for attr_name in dir(type(self)):
+            flag = getattr(getattr(type(self), attr_name, None), '__cmd_arg_flag__', None)
+            if flag is not None:
+                methods[flag] = getattr(self, attr_name)
+        return methods
 
     def add_arg(self, arg_flag, arg: CmdArg):
         """
@@ -37,7 +158,11 @@ class Cmd(object):
         :param arg_flag: 参数的标识符，根据该标识符存取参数对象。若命令提供多个参数，标识符不可重复
         :param arg: 参数对象 CmdArg
         """
+        if isinstance(self.__args, MappingProxyType):
+            # 类属性中声明的参数是共享的，添加参数时复制一份
+            self.__args = OrderedDict(self.__args)
         self.__args[arg_flag] = arg
+        self.__handlers = None
 
     def get_arg(self, arg_flag):
         """
@@ -104,23 +229,68 @@ class Cmd(object):
         """
         return tuple(self.__args.values())
 
-    @abstractmethod
+    def handlers(self):
+        """
+        参数的处理函数表，短参名与长参名均映射到同一个处理函数，只在首次调用时生成。
+        处理函数来自 CmdArg 中的 handler 或 arg_handler 装饰的方法，未绑定处理函数的参数不在表中
+
+        :return: key为短参名或长参名，value为处理函数
+        """
+        if self.__handlers is not None:
+            return self.__handlers
+        handlers = {}
+        flag_methods = self.__flag_methods()
+        for arg_flag, cmd_arg in self.__args.items():
+            handler = cmd_arg.handler
+            if isinstance(handler, str):
+                handler = getattr(self, handler)
+            elif handler is None:
+                handler = flag_methods.get(arg_flag)
+            if handler is None:
+                continue
+            if cmd_arg.short_name:
+                handlers[cmd_arg.short_name] = handler
+            if cmd_arg.long_name:
+                handlers[cmd_arg.long_name] = handler
+        self.__handlers = handlers
+        return handlers
+
     def name(self):
         """
-        命令名
+        命令名，默认为类属性中声明的 cmd_name
 
         :return: 命令名（字符串）
         """
-        return ''
+        return type(self).cmd_name or ''
 
     @abstractmethod
     def exec(self, short_arg, long_arg, value):
         """
-        执行指令
+        执行指令。参数绑定了处理函数时不会调用此方法，此方法作为未绑定处理函数的参数的处理
+
+        :param short_arg: 指令中的短参数，若使用长参数此处可能为空
+        :param long_arg: 指令中的长参数，若使用短参数此处可能为空
+        :param value: 指令中的参数值
+        :return: 返回 int 时作为退出码，其他返回值视为执行成功。处理函数的返回值同理
+        """
+        pass
+
+
+class AsyncCmd(Cmd):
+    """
+    异步子命令的基类，exec 以及参数的处理函数可以是协程函数，适合等待 service、systemctl 等外部命令的 I/O 密集型子命令。
+    通过 util.cmd_helper 中的 run_cmd_async、run_many_async 运行时直接在事件循环中等待；通过 run_cmd 运行时在新的事件循环中运行至结束
+    """
+
+    @abstractmethod
+    async def exec(self, short_arg, long_arg, value):
+        """
+        执行指令的协程，参考 Cmd.exec
 
         :param short_arg: 指令中的短参数，若使用长参数此处可能为空
         :param long_arg: 指令中的长参数，若使用短参数此处可能为空
         :param value: 指令中的参数值
+        :return: 返回 int 时作为退出码，其他返回值视为执行成功
         """
         pass
 
@@ -1,7 +1,10 @@
 # -*- coding: UTF-8 -*-
-import os
+from command import Cmd, CmdArg, arg_handler
+from command.process import run_process
 
-from command import Cmd, CmdArg
+SERVICE_ARGV = ['sudo', 'service', 'network-manager']
+STATUS_ARGV = ['service', 'network-manager', 'status']
+STATUS_CACHE_TTL = 5    # 状态查询结果的缓存秒数
 
 
 class NetworkCmd(Cmd):
@@ -9,23 +12,32 @@ class NetworkCmd(Cmd):
     start_flag = 'start'
     stop_flag = 'stop'
     restart_flag = 'restart'
+    status_flag = 'status'
 
-    def __init__(self):
-        super().__init__()
-        self.add_arg(NetworkCmd.start_flag, CmdArg('-s', '--start', False, 'Run service network-manager start.'))
-        self.add_arg(NetworkCmd.stop_flag, CmdArg('-t', '--stop', False, 'Run service network-manager stop.'))
-        self.add_arg(NetworkCmd.restart_flag, CmdArg('-r', '--restart', False, 'Run service network-manager restart.'))
+    cmd_name = 'network'
+    cmd_args = (
+        (start_flag, CmdArg('-s', '--start', False, 'Run service network-manager start.')),
+        (stop_flag, CmdArg('-t', '--stop', False, 'Run service network-manager stop.')),
+        (restart_flag, CmdArg('-r', '--restart', False, 'Run service network-manager restart.')),
+        (status_flag, CmdArg('-i', '--status', False, 'Run service network-manager status.',
+                             cache_ttl=STATUS_CACHE_TTL)),
+    )
 
-    def name(self):
-        return 'network'
+    @arg_handler(start_flag)
+    def start(self, value):
+        return run_process(SERVICE_ARGV + ['start']).returncode
+
+    @arg_handler(stop_flag)
+    def stop(self, value):
+        return run_process(SERVICE_ARGV + ['stop']).returncode
+
+    @arg_handler(restart_flag)
+    def restart(self, value):
+        return run_process(SERVICE_ARGV + ['restart']).returncode
+
+    @arg_handler(status_flag)
+    def status(self, value):
+        return run_process(STATUS_ARGV).returncode
 
     def exec(self, short_arg, long_arg, value):
-        if short_arg == self.short_name(NetworkCmd.start_flag) \
-                or long_arg == self.long_name(NetworkCmd.start_flag):
-            os.system('sudo service network-manager start')
-        elif short_arg == self.short_name(NetworkCmd.stop_flag) \
-                or long_arg == self.long_name(NetworkCmd.stop_flag):
-            os.system('sudo service network-manager stop')
-        elif short_arg == self.short_name(NetworkCmd.restart_flag) \
-                or long_arg == self.long_name(NetworkCmd.restart_flag):
-            os.system('sudo service network-manager restart')
+        pass
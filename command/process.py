@@ -0,0 +1,401 @@
+# -*- coding: UTF-8 -*-
+import mmap
+import os
+import selectors
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+WAIT_ALL = 'all'    # 并行执行时等待全部进程结束
+FIRST_FAILURE = 'first_failure'     # 并行执行时任一进程失败即终止其他进程
+TIMEOUT_EXIT_CODE = 124     # 超时的退出码，与 coreutils 的 timeout 命令一致
+NOT_FOUND_EXIT_CODE = 127   # 命令不存在的退出码，与 shell 一致
+POLL_INTERVAL = 0.05
+TERMINATE_GRACE = 1.0    # 终止进程时先发送 SIGTERM，等待此秒数后仍未退出时发送 SIGKILL
+READ_CHUNK_SIZE = 64 * 1024
+DEFAULT_TAIL_SIZE = 64 * 1024   # 环形缓冲区的大小
+DEFAULT_SPILL_THRESHOLD = 1024 * 1024   # 输出超过此大小时写入临时文件
+
+
+class RingBuffer(object):
+    """
+    固定大小的环形缓冲区，只保留最后写入的 capacity 个字节
+    """
+
+    def __init__(self, capacity):
+        """
+        创建环形缓冲区
+
+        :param capacity: 缓冲区大小（字节）
+        """
+        self.__buf = bytearray(capacity)
+        self.__capacity = capacity
+        self.__pos = 0  # 下一次写入的位置
+        self.__full = False
+
+    def write(self, data):
+        """
+        写入数据，超出容量的旧数据被覆盖
+
+        :param data: 写入的数据 (bytes)
+        """
+        if self.__capacity == 0:
+            return
+        data = memoryview(data)
+        if len(data) >= self.__capacity:
+            self.__buf[:] = data[len(data) - self.__capacity:]
+            self.__pos = 0
+            self.__full = True
+            return
+        first = min(len(data), self.__capacity - self.__pos)
+        self.__buf[self.__pos:self.__pos + first] = data[:first]
+        rest = len(data) - first
+        if rest:
+            self.__buf[:rest] = data[first:]
+        self.__pos = (self.__pos + len(data)) % self.__capacity
+        if rest or self.__pos == 0:
+            self.__full = True
+
+    def getvalue(self):
+        """
+        获取缓冲区中的数据
+
+        :return: 按写入顺序排列的数据 (bytes)
+        """
+        if not self.__full:
+            return bytes(self.__buf[:self.__pos])
+        return bytes(self.__buf[self.__pos:]) + bytes(self.__buf[:self.__pos])
+
+
+class OutputCapture(object):
+    """
+    流式捕获输出，内存占用有上限。写入的数据立即转发给 sink（默认为当前进程的标准输出），
+    最后的 tail_size 个字节保留在环形缓冲区中，全部输出在 spill_threshold 以内时保存在内存中，
+    超过后转存到临时文件，通过 view() 以内存映射的方式访问，无需将全部输出读入内存
+    """
+
+    def __init__(self, sink=None, forward=True, tail_size=DEFAULT_TAIL_SIZE, spill_threshold=DEFAULT_SPILL_THRESHOLD):
+        """
+        创建输出捕获
+
+        :param sink: 转发的目标，二进制的文件对象，为空时为当前进程的标准输出
+        :param forward: 是否转发，为 False 时只保存不转发
+        :param tail_size: 环形缓冲区的大小（字节）
+        :param spill_threshold: 内存中保存的最大字节数，超过后转存到临时文件
+        """
+        self.__sink = (sink if sink is not None else sys.stdout.buffer) if forward else None
+        self.__tail = RingBuffer(tail_size)
+        self.__threshold = spill_threshold
+        self.__memory = bytearray()
+        self.__spill_file = None
+        self.__mmap = None
+        self.__size = 0
+
+    def write(self, data):
+        """
+        写入一段输出
+
+        :param data: 输出的数据 (bytes)
+        """
+        if not data:
+            return
+        if self.__sink is not None:
+            self.__sink.write(data)
+            self.__sink.flush()
+        self.__tail.write(data)
+        self.__size += len(data)
+        if self.__spill_file is None and self.__size > self.__threshold:
+            self.__spill_file = tempfile.TemporaryFile(prefix='cmd_output_')
+            self.__spill_file.write(self.__memory)
+            self.__memory = bytearray()
+        if self.__spill_file is not None:
+            self.__spill_file.write(data)
+        else:
+            self.__memory.extend(data)
+
+    def size(self):
+        """
+        已写入的总字节数
+
+        :return: 字节数
+        """
+        return self.__size
+
+    def spilled(self):
+        """
+        输出是否已转存到临时文件
+
+        :return: 超过 spill_threshold 时返回 True
+        """
+        return self.__spill_file is not None
+
+    def tail(self):
+        """
+        获取最后的输出，最多 tail_size 个字节
+
+        :return: 最后的输出 (bytes)
+        """
+        return self.__tail.getvalue()
+
+    def view(self):
+        """
+        获取全部输出的只读视图。已转存到临时文件时为内存映射，由操作系统按需读取，不会将全部输出读入内存
+
+        :return: memoryview 对象，可切片、查找，或通过 bytes() 转换
+        """
+        if self.__spill_file is None:
+            return memoryview(bytes(self.__memory))
+        if self.__mmap is None or len(self.__mmap) != self.__size:
+            self.__spill_file.flush()
+            if self.__mmap is not None:
+                self.__mmap.close()
+            self.__mmap = mmap.mmap(self.__spill_file.fileno(), self.__size, access=mmap.ACCESS_READ)
+        return memoryview(self.__mmap)
+
+    def close(self):
+        """
+        释放临时文件与内存映射，之后不可再访问输出
+        """
+        if self.__mmap is not None:
+            self.__mmap.close()
+            self.__mmap = None
+        if self.__spill_file is not None:
+            self.__spill_file.close()
+            self.__spill_file = None
+        self.__memory = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ProcessResult(object):
+    """
+    进程的执行结果，存储了命令、退出码、捕获的标准输出与标准错误
+    """
+
+    def __init__(self, argv, returncode, stdout=None, stderr=None, timed_out=False, terminated=False, output=None):
+        """
+        创建执行结果
+
+        :param argv: 执行的命令 (list)
+        :param returncode: 退出码，被信号终止时为负的信号值
+        :param stdout: 捕获的标准输出 (str)，未捕获时为空
+        :param stderr: 捕获的标准错误 (str)，未捕获时为空
+        :param timed_out: 是否因超时被终止
+        :param terminated: 是否因其他进程失败被终止，仅在 FIRST_FAILURE 策略下出现
+        :param output: 流式捕获的输出 OutputCapture，未使用流式捕获时为空
+        """
+        self.argv = argv
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+        self.terminated = terminated
+        self.output = output
+
+    def ok(self):
+        """
+        是否执行成功
+
+        :return: 退出码为 0 时返回 True
+        """
+        return self.returncode == 0
+
+
+def _spawn(argv, capture, env, cwd, new_session=False):
+    """
+    启动进程，不经过 shell。new_session 为 True 时进程作为新会话的首进程启动，
+    终止时可以通过进程组一并终止它启动的子进程（如 sudo 启动的命令），但进程不再关联控制终端
+
+    :return: (进程对象, 启动失败时的执行结果)
+    """
+    pipe = subprocess.PIPE if capture else None
+    try:
+        return subprocess.Popen(argv, stdout=pipe, stderr=pipe, env=env, cwd=cwd,
+                                universal_newlines=capture, start_new_session=new_session), None
+    except (FileNotFoundError, PermissionError) as e:
+        print('%s: %s' % (argv[0], e.strerror), file=sys.stderr)
+        if capture:
+            return None, ProcessResult(argv, NOT_FOUND_EXIT_CODE, '', e.strerror)
+        return None, ProcessResult(argv, NOT_FOUND_EXIT_CODE)
+
+
+def _signal(proc, sig, group):
+    """
+    向进程发送信号，group 为 True 时发送给整个进程组，进程必须以 new_session 启动
+    """
+    try:
+        if group:
+            os.killpg(proc.pid, sig)
+        else:
+            proc.send_signal(sig)
+    except ProcessLookupError:
+        pass
+
+
+def _terminate(procs, group):
+    """
+    终止多个进程并等待其退出：先同时发送 SIGTERM，TERMINATE_GRACE 秒后仍未退出的进程发送 SIGKILL
+    """
+    for proc in procs:
+        _signal(proc, signal.SIGTERM, group)
+    deadline = time.monotonic() + TERMINATE_GRACE
+    for proc in procs:
+        try:
+            proc.wait(max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            _signal(proc, signal.SIGKILL, group)
+            proc.wait()
+
+
+def _wait(proc, argv, timeout):
+    """
+    等待进程结束。超时时终止进程所在的进程组：先发送 SIGTERM（sudo 等会将其转发给启动的命令），
+    TERMINATE_GRACE 秒后仍未退出时发送 SIGKILL。设置了超时的进程必须以 new_session 启动
+
+    :return: 执行结果
+    """
+    try:
+        stdout, stderr = proc.communicate(timeout=timeout)
+        return ProcessResult(argv, proc.returncode, stdout, stderr)
+    except subprocess.TimeoutExpired:
+        _signal(proc, signal.SIGTERM, True)
+        try:
+            stdout, stderr = proc.communicate(timeout=TERMINATE_GRACE)
+        except subprocess.TimeoutExpired:
+            _signal(proc, signal.SIGKILL, True)
+            stdout, stderr = proc.communicate()
+        return ProcessResult(argv, TIMEOUT_EXIT_CODE, stdout, stderr, timed_out=True)
+
+
+def run_process(argv, timeout=None, capture=False, env=None, cwd=None):
+    """
+    执行一个命令。命令以参数列表传入，不经过 /bin/sh，因此不会有额外的 shell 进程，也无需处理参数的转义。
+    处理函数可以直接返回 run_process(...).returncode，退出码会通过 run_cmd 传递给 cmd.py 的退出码
+
+    :param argv: 命令及参数的列表，如 ['service', 'network-manager', 'start']
+    :param timeout: 超时秒数，超时后终止进程及其启动的子进程，退出码为 TIMEOUT_EXIT_CODE；为空时不限时。
+                    设置了超时的命令在新会话中运行，不关联控制终端，无法从终端交互式地读取输入（如 sudo 询问密码）
+    :param capture: 是否捕获标准输出与标准错误，默认直接输出到当前进程的标准输出与标准错误
+    :param env: 环境变量，为空时继承当前进程
+    :param cwd: 工作目录，为空时继承当前进程
+    :return: 执行结果 ProcessResult，命令不存在时退出码为 NOT_FOUND_EXIT_CODE
+    """
+    proc, failed = _spawn(argv, capture, env, cwd, new_session=timeout is not None)
+    if failed:
+        return failed
+    return _wait(proc, argv, timeout)
+
+
+def stream_process(argv, output: OutputCapture, timeout=None, merge_stderr=False, env=None, cwd=None):
+    """
+    执行一个命令，并以流式的方式捕获标准输出：输出一边产生一边转发，同时保存在 output 中，内存占用有上限，适合输出很大的命令
+
+    :param argv: 命令及参数的列表
+    :param output: 输出捕获 OutputCapture
+    :param timeout: 超时秒数，包括输出结束后等待进程退出的时间，超时后终止进程及其启动的子进程，退出码为 TIMEOUT_EXIT_CODE；
+                    为空时不限时。设置了超时的命令在新会话中运行，参考 run_process
+    :param merge_stderr: 是否将标准错误合并到标准输出中，默认标准错误直接输出到当前进程的标准错误
+    :param env: 环境变量，为空时继承当前进程
+    :param cwd: 工作目录，为空时继承当前进程
+    :return: 执行结果 ProcessResult，其中 output 为传入的输出捕获
+    :raise: output 写入时抛出的异常（如 BrokenPipeError），抛出前终止进程
+    """
+    new_session = timeout is not None
+    try:
+        proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT if merge_stderr else None,
+                                env=env, cwd=cwd, start_new_session=new_session)
+    except (FileNotFoundError, PermissionError) as e:
+        print('%s: %s' % (argv[0], e.strerror), file=sys.stderr)
+        return ProcessResult(argv, NOT_FOUND_EXIT_CODE, output=output)
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    fd = proc.stdout.fileno()
+    timed_out = False
+    try:
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+            while True:
+                wait = None if deadline is None else deadline - time.monotonic()
+                if wait is not None and wait <= 0:
+                    timed_out = True
+                    break
+                if not selector.select(wait):
+                    continue
+                data = os.read(fd, READ_CHUNK_SIZE)
+                if not data:
+                    break
+                output.write(data)
+        if not timed_out:
+            # 输出已结束，但进程可能关闭了标准输出后继续运行
+            try:
+                proc.wait(None if deadline is None else max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                timed_out = True
+    finally:
+        # 超时或转发输出时抛出异常（如 BrokenPipeError），终止进程，避免遗留未回收的子进程
+        if proc.poll() is None:
+            _terminate([proc], new_session)
+        proc.stdout.close()
+    if timed_out:
+        return ProcessResult(argv, TIMEOUT_EXIT_CODE, timed_out=True, output=output)
+    return ProcessResult(argv, proc.returncode, output=output)
+
+
+def run_processes(argv_list, policy=WAIT_ALL, timeout=None, capture=False, env=None, cwd=None):
+    """
+    并行执行多个命令
+
+    :param argv_list: 命令的列表，每个元素为命令及参数的列表
+    :param policy: WAIT_ALL 等待全部命令结束；FIRST_FAILURE 任一命令失败时终止其他仍在运行的命令及其启动的子进程，
+                   TERMINATE_GRACE 秒后仍未退出时杀死
+    :param timeout: 每个命令的超时秒数，为空时不限时。设置了超时或使用 FIRST_FAILURE 时，命令在新会话中运行，参考 run_process
+    :param capture: 是否捕获标准输出与标准错误
+    :param env: 环境变量，为空时继承当前进程
+    :param cwd: 工作目录，为空时继承当前进程
+    :return: 执行结果 ProcessResult 的列表，顺序与 argv_list 一致
+    """
+    results = [None] * len(argv_list)
+    procs = [None] * len(argv_list)
+    failed = threading.Event()
+    threads = []
+
+    def wait(i):
+        results[i] = _wait(procs[i], argv_list[i], timeout)
+        if not results[i].ok():
+            failed.set()
+
+    new_session = timeout is not None or policy == FIRST_FAILURE
+    for i, argv in enumerate(argv_list):
+        procs[i], results[i] = _spawn(argv, capture, env, cwd, new_session)
+        if procs[i] is None:
+            failed.set()
+            continue
+        thread = threading.Thread(target=wait, args=(i,), daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    if policy == FIRST_FAILURE:
+        while not failed.is_set() and any(t.is_alive() for t in threads):
+            failed.wait(POLL_INTERVAL)
+        terminated = set()
+        if failed.is_set():
+            for i, proc in enumerate(procs):
+                if proc is not None and proc.poll() is None:
+                    terminated.add(i)
+            _terminate([procs[i] for i in terminated], True)
+        for thread in threads:
+            thread.join()
+        for i in terminated:
+            results[i].terminated = True
+        return results
+
+    for thread in threads:
+        thread.join()
+    return results
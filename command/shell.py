@@ -0,0 +1,279 @@
+# -*- coding: UTF-8 -*-
+import atexit
+import os
+import selectors
+import shlex
+import signal
+import subprocess
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from command.process import READ_CHUNK_SIZE, TIMEOUT_EXIT_CODE, ProcessResult
+
+SHELL_ARGV = ['/bin/sh']
+DEFAULT_POOL_SIZE = 2
+CLOSE_TIMEOUT = 1.0     # 关闭会话时等待 shell 退出的秒数，超时后杀死
+MARKER_PREFIX = '__cmd_shell_'
+# 每条命令之后输出的结束标记：标准输出为 "\n<标记> <退出码>\n"，标准错误为 "\n<标记>\n"
+# command eval 使命令中的语法错误不会导致 shell 退出
+COMMAND_TEMPLATE = "command eval %s </dev/null\nprintf '\\n%%s %%d\\n' %s \"$?\"\nprintf '\\n%%s\\n' %s >&2\n"
+
+
+class ShellSession(object):
+    """
+    常驻的 shell 会话。shell 只启动一次，之后的命令通过标准输入发送给同一个 shell 执行，
+    每条命令无需再 fork/exec 一个 /bin/sh；cd、export 等对工作目录和环境变量的修改在之后的命令中保持。
+    每条命令之后输出随机生成的结束标记，以此分隔每条命令的标准输出、标准错误与退出码，命令的标准输入为 /dev/null。
+    同一个会话同时只能由一个线程使用
+    """
+
+    def __init__(self, shell=None, env=None, cwd=None):
+        """
+        创建会话，在首次执行命令时启动 shell
+
+        :param shell: shell 及其参数的列表，为空时为 SHELL_ARGV
+        :param env: 环境变量，为空时继承当前进程
+        :param cwd: 工作目录，为空时继承当前进程
+        """
+        self.__shell = list(shell) if shell else SHELL_ARGV
+        self.__env = env
+        self.__cwd = cwd
+        self.__proc = None  # shell 进程
+        self.__selector = None  # 读取标准输出与标准错误
+        self.__returncode = None    # shell 退出后的退出码
+
+    def start(self):
+        """
+        启动 shell，已启动时忽略
+
+        :return: 当前对象，允许链式调用
+        """
+        if self.__proc is not None:
+            return self
+        # shell 作为新会话的首进程，超时时可以杀死整个进程组，包括命令启动的子进程
+        self.__proc = subprocess.Popen(self.__shell, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE, env=self.__env, cwd=self.__cwd, bufsize=0,
+                                       start_new_session=True)
+        self.__selector = selectors.DefaultSelector()
+        self.__selector.register(self.__proc.stdout, selectors.EVENT_READ, 'stdout')
+        self.__selector.register(self.__proc.stderr, selectors.EVENT_READ, 'stderr')
+        return self
+
+    def alive(self):
+        """
+        shell 是否仍在运行。命令中执行了 exit、exec 或超时后，shell 已退出，会话不可再使用
+
+        :return: 已启动且未退出时返回 True
+        """
+        return self.__proc is not None and self.__returncode is None and self.__proc.poll() is None
+
+    def __kill(self):
+        try:
+            os.killpg(self.__proc.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        self.__returncode = self.__proc.wait()
+
+    def __drain(self, buffers):
+        """
+        shell 已退出，读取剩余的输出直到两个管道都结束
+        """
+        while self.__selector.get_map():
+            for key, _ in self.__selector.select():
+                data = os.read(key.fd, READ_CHUNK_SIZE)
+                if data:
+                    buffers[key.data] += data
+                else:
+                    self.__selector.unregister(key.fileobj)
+        self.__returncode = self.__proc.wait()
+
+    def run(self, command, timeout=None):
+        """
+        在会话中执行一条命令
+
+        :param command: shell 命令，如 'cd /etc && ls'，按照 shell 的规则解析
+        :param timeout: 超时秒数，超时后杀死 shell 及其启动的全部进程，会话随之结束，退出码为 TIMEOUT_EXIT_CODE；为空时不限时
+        :return: 执行结果 ProcessResult，stdout、stderr 为 str；命令使 shell 退出时，退出码为 shell 的退出码
+        :raise RuntimeError: 会话已结束
+        """
+        self.start()
+        if not self.alive():
+            raise RuntimeError('Shell session has exited with code %s' % self.__proc.poll())
+        marker = (MARKER_PREFIX + uuid.uuid4().hex).encode('ascii')
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        script = COMMAND_TEMPLATE % (shlex.quote(command), marker.decode('ascii'), marker.decode('ascii'))
+        buffers = {'stdout': bytearray(), 'stderr': bytearray()}
+        ends = {'stdout': b'\n' + marker + b' ', 'stderr': b'\n' + marker + b'\n'}
+        found = {}  # 已找到结束标记的管道，value为标记在输出中的位置
+
+        try:
+            self.__proc.stdin.write(script.encode('utf-8'))
+        except BrokenPipeError:
+            self.__drain(buffers)
+            return self.__result(command, buffers, found, self.__returncode)
+
+        returncode = None
+        while returncode is None or len(found) < 2:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.__kill()
+                    return self.__result(command, buffers, found, TIMEOUT_EXIT_CODE, timed_out=True)
+            for key, _ in self.__selector.select(remaining):
+                buf = buffers[key.data]
+                data = os.read(key.fd, READ_CHUNK_SIZE)
+                if not data:
+                    self.__drain(buffers)
+                    return self.__result(command, buffers, found, self.__returncode)
+                start = max(0, len(buf) - len(ends[key.data]))
+                buf += data
+                if key.data not in found:
+                    pos = buf.find(ends[key.data], start)
+                    if pos >= 0:
+                        found[key.data] = pos
+                if key.data == 'stdout' and 'stdout' in found and returncode is None:
+                    line_start = found['stdout'] + len(ends['stdout'])
+                    line_end = buf.find(b'\n', line_start)
+                    if line_end >= 0:
+                        returncode = int(buf[line_start:line_end])
+        return self.__result(command, buffers, found, returncode)
+
+    @staticmethod
+    def __result(command, buffers, found, returncode, timed_out=False):
+        stdout = buffers['stdout'][:found.get('stdout', len(buffers['stdout']))]
+        stderr = buffers['stderr'][:found.get('stderr', len(buffers['stderr']))]
+        return ProcessResult(command, returncode, stdout.decode('utf-8', 'replace'),
+                             stderr.decode('utf-8', 'replace'), timed_out=timed_out)
+
+    def close(self):
+        """
+        结束 shell，未在 CLOSE_TIMEOUT 秒内退出时杀死
+        """
+        if self.__proc is None:
+            return
+        if self.__returncode is None:
+            try:
+                self.__proc.stdin.close()
+            except OSError:
+                pass
+            try:
+                self.__returncode = self.__proc.wait(CLOSE_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.__kill()
+        self.__selector.close()
+        self.__proc.stdout.close()
+        self.__proc.stderr.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ShellPool(object):
+    """
+    shell 会话池，最多保留 size 个常驻的 ShellSession。通过 session() 取出一个会话，
+    同一个 with 块中的命令在同一个 shell 中依次执行；归还时工作目录恢复为初始目录，已退出的会话被丢弃，下次按需重新启动。
+    export 的环境变量在会话中保持，只作用于一条命令的变量使用 VAR=value command 的写法。
+    进程退出时自动关闭全部会话
+    """
+
+    def __init__(self, size=DEFAULT_POOL_SIZE, shell=None, env=None, cwd=None):
+        """
+        创建会话池，会话在首次取出时启动
+
+        :param size: 会话数的上限，会话都在使用中时 session() 等待其他线程归还
+        :param shell: shell 及其参数的列表，为空时为 SHELL_ARGV
+        :param env: 环境变量，为空时继承当前进程
+        :param cwd: 会话的初始工作目录，为空时为当前进程的工作目录
+        """
+        self.__size = size
+        self.__shell = shell
+        self.__env = env
+        self.__cwd = os.path.abspath(cwd) if cwd else os.getcwd()
+        self.__idle = []    # 空闲的会话
+        self.__count = 0    # 已创建且未丢弃的会话数
+        self.__closed = False
+        self.__cond = threading.Condition()
+        atexit.register(self.close)
+
+    def __acquire(self):
+        with self.__cond:
+            while True:
+                if self.__closed:
+                    raise RuntimeError('Shell pool is closed')
+                if self.__idle:
+                    return self.__idle.pop()
+                if self.__count < self.__size:
+                    self.__count += 1
+                    break
+                self.__cond.wait()
+        try:
+            return ShellSession(self.__shell, self.__env, self.__cwd).start()
+        except Exception:
+            with self.__cond:
+                self.__count -= 1
+                self.__cond.notify()
+            raise
+
+    def __release(self, session: ShellSession):
+        if session.alive() and not self.__closed:
+            if session.run('cd -- %s' % shlex.quote(self.__cwd)).ok():
+                with self.__cond:
+                    if not self.__closed:
+                        self.__idle.append(session)
+                        self.__cond.notify()
+                        return
+        session.close()
+        with self.__cond:
+            self.__count -= 1
+            self.__cond.notify()
+
+    @contextmanager
+    def session(self):
+        """
+        取出一个会话，用于 with 语句，with 块结束时归还
+
+            with pool.session() as sh:
+                sh.run('cd /var/log')
+                result = sh.run('ls')
+
+        :return: ShellSession
+        """
+        session = self.__acquire()
+        try:
+            yield session
+        finally:
+            self.__release(session)
+
+    def run(self, command, timeout=None):
+        """
+        取出一个会话执行一条命令后归还
+
+        :param command: shell 命令
+        :param timeout: 超时秒数，为空时不限时
+        :return: 执行结果 ProcessResult
+        """
+        with self.session() as session:
+            return session.run(command, timeout=timeout)
+
+    def close(self):
+        """
+        关闭全部空闲的会话，使用中的会话在归还时关闭
+        """
+        with self.__cond:
+            self.__closed = True
+            idle, self.__idle = self.__idle, []
+            self.__cond.notify_all()
+        for session in idle:
+            session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
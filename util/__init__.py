@@ -1,5 +1,12 @@
 # -*- coding: UTF-8 -*-
+import os
+import stat
+import sys
+import traceback
 from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+
+from util.cmd_profiler import NULL_PROFILER
 
 
 class CmdLoader(object):
@@ -7,6 +14,27 @@ class CmdLoader(object):
     Cmd实现类加载器，需要实现如何加载并返回所有Cmd实现类
     """
     __metaclass__ = ABCMeta
+    __profiler = None
+
+    def set_profiler(self, profiler):
+        """
+        设置性能分析器，各阶段的耗时将记录到分析器中，参考 util.cmd_profiler.CmdProfiler
+
+        :param profiler: 性能分析器，为空时不记录
+        :return: 当前对象，允许链式调用
+        """
+        self.__profiler = profiler
+        return self
+
+    def profiler(self):
+        """
+        获取性能分析器
+
+        :return: 性能分析器，未设置时返回不记录任何数据的 NULL_PROFILER
+        """
+        if self.__profiler is None:
+            return NULL_PROFILER
+        return self.__profiler
 
     @abstractmethod
     def load(self):
@@ -26,12 +54,92 @@ class CmdLoader(object):
         """
         return []
 
+    def reload(self):
+        """
+        重新加载，默认调用 load 重新加载全部子命令
+
+        :return: (新增的子命令名, 修改的子命令名, 删除的子命令名)，均为集合，默认实现中所有保留的子命令都视为修改
+        """
+        old_names = set(self.cmd_names())
+        self.load()
+        new_names = set(self.cmd_names())
+        return new_names - old_names, new_names & old_names, old_names - new_names
+
+    def is_lazy(self):
+        """
+        是否为懒加载模式。懒加载模式下 load 只建立子命令名的索引，子命令实例在 cmd_instance 中按需创建
+
+        :return: 默认返回 False
+        """
+        return False
+
+    def cmd_names(self):
+        """
+        获取所有子命令名
+
+        :return: 子命令名列表
+        """
+        return [cmd.name() for cmd in self.cmd_instances()]
+
+    def cmd_instance(self, name):
+        """
+        通过子命令名获取Cmd实例
+
+        :param name: 子命令名
+        :return: Cmd实例，子命令不存在时返回空
+        """
+        for cmd in self.cmd_instances():
+            if cmd.name() == name:
+                return cmd
+        return None
+
+    def cmd_args(self, name):
+        """
+        通过子命令名获取子命令的参数定义
+
+        :param name: 子命令名
+        :return: 参数对象CmdArg的元组，子命令不存在时返回空
+        """
+        cmd = self.cmd_instance(name)
+        if not cmd:
+            return None
+        return cmd.args()
+
+    def cmd_specs(self):
+        """
+        获取所有子命令的子命令名与参数定义
+
+        :return: (子命令名, 参数对象元组) 的列表
+        """
+        return [(cmd.name(), cmd.args()) for cmd in self.cmd_instances()]
+
 
 class CmdHelper(object):
     """
     Cmd帮助工具，提供生成命令的帮助、运行命令等操作
     """
     __metaclass__ = ABCMeta
+    __profiler = None
+
+    def set_profiler(self, profiler):
+        """
+        设置性能分析器，各阶段的耗时将记录到分析器中，参考 util.cmd_profiler.CmdProfiler
+
+        :param profiler: 性能分析器，为空时不记录
+        :return: 当前对象，允许链式调用
+        """
+        self.__profiler = profiler
+        return self
+
+    def profiler(self):
+        """
+        获取性能分析器
+
+        :return: 性能分析器，未设置时返回不记录任何数据的 NULL_PROFILER
+        """
+        if self.__profiler is None:
+            return NULL_PROFILER
+        return self.__profiler
 
     @abstractmethod
     def set_cmd_loader(self, cmd_loader: CmdLoader):
@@ -80,6 +188,48 @@ class CmdHelper(object):
         """
         pass
 
+    def parser(self, subcmd):
+        """
+        获取子命令的参数解析器（util.cmd_parser.CmdParser），默认没有解析器，此时使用 getopt 与 short_opts、long_opts 解析
+
+        :param subcmd: 子命令的名称
+        :return: 参数解析器，默认返回空
+        """
+        return None
+
+    def resolve_subcmd(self, name):
+        """
+        将命令行中的子命令名解析为完整的子命令名，默认只接受完整的子命令名
+
+        :param name: 命令行中的子命令名
+        :return: 完整的子命令名，无法解析时返回空
+        """
+        return name if self.short_opts(name) is not None else None
+
+    def suggest_subcmds(self, name):
+        """
+        与未知的子命令名相近的子命令名，默认没有建议
+
+        :param name: 未知的子命令名
+        :return: 子命令名的列表，越相近越靠前
+        """
+        return []
+
+    def metrics(self):
+        """
+        获取执行指标，默认不记录
+
+        :return: util.cmd_metrics.CmdMetrics，未设置时返回空
+        """
+        return None
+
+    @contextmanager
+    def concurrently(self):
+        """
+        标记 with 块中的调用会并发执行，默认不做任何处理
+        """
+        yield self
+
     @abstractmethod
     def run(self, sub_cmd, opt, value):
         """
@@ -91,6 +241,99 @@ class CmdHelper(object):
         """
         pass
 
+    def run_all(self, sub_cmd, opts):
+        """
+        运行子命令中的多个参数，默认按顺序逐个调用 run
+
+        :param sub_cmd: 子命令名
+        :param opts: (参数名, 参数值) 的列表
+        :return: 每个参数的执行结果 OptResult 的列表，顺序与 opts 一致
+        """
+        results = []
+        for opt, value in opts:
+            results.append(OptResult.call(opt, value, self.run, sub_cmd, opt, value))
+        return results
+
+
+class OptResult(object):
+    """
+    一个参数的执行结果，存储了参数名、参数值、返回值以及执行中抛出的异常
+    """
+
+    def __init__(self, opt, value, result=None, error=None):
+        """
+        创建执行结果
+
+        :param opt: 参数名
+        :param value: 参数值
+        :param result: 处理函数或 exec 的返回值
+        :param error: 执行中抛出的异常，未抛出异常时为空
+        """
+        self.opt = opt
+        self.value = value
+        self.result = result
+        self.error = error
+
+    @staticmethod
+    def call(opt, value, func, *args):
+        """
+        调用函数并将返回值或异常记录为执行结果，异常的堆栈输出到标准错误
+
+        :param opt: 参数名
+        :param value: 参数值
+        :param func: 执行的函数
+        :param args: 函数的参数
+        :return: 执行结果 OptResult
+        """
+        try:
+            return OptResult(opt, value, result=func(*args))
+        except Exception as e:
+            traceback.print_exc(file=sys.stderr)
+            return OptResult(opt, value, error=e)
+
+    def exit_code(self):
+        """
+        执行结果对应的退出码。抛出异常时为 1，返回值为 int 时即为退出码，其他返回值为 0
+
+        :return: 退出码
+        """
+        if self.error is not None:
+            return 1
+        if isinstance(self.result, int) and not isinstance(self.result, bool):
+            return self.result
+        return 0
+
+
+def ensure_private_dir(path):
+    """
+    确保目录存在且只有当前用户可以访问。目录不存在时以 0700 权限创建；已存在时检查其属主为当前用户，
+    且组和其他用户没有任何权限，防止其他本地用户预先创建同名目录（如 /tmp 下的目录）后篡改其中的文件
+
+    :param path: 目录路径
+    :return: 目录路径
+    :raise InsecurePathError: 目录不是当前用户所有、权限过宽，或不是目录（如符号链接）
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise InsecurePathError('Refusing to use %s: it must be a directory owned by uid %d with mode 0700'
+                                % (path, os.getuid()))
+    return path
+
+
+def results_exit_code(results):
+    """
+    多个执行结果汇总后的退出码，即第一个非 0 的退出码
+
+    :param results: 执行结果 OptResult 的列表
+    :return: 退出码，全部成功时为 0
+    """
+    for result in results:
+        code = result.exit_code()
+        if code:
+            return code
+    return 0
+
 
 class Const(object):
     """
@@ -136,3 +379,23 @@ class InsufficientParametersError(CommandException):
     """
     pass
 
+
+class CommandTimeoutError(CommandException):
+    """
+    异常：执行超时
+    """
+    pass
+
+
+class WorkerDiedError(CommandException):
+    """
+    异常：执行子命令的工作进程意外退出
+    """
+    pass
+
+
+class InsecurePathError(CommandException):
+    """
+    异常：共享的目录或套接字不属于当前用户，或权限过宽
+    """
+    pass
@@ -0,0 +1,218 @@
+# -*- coding: UTF-8 -*-
+import io
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+
+from util import ensure_private_dir
+
+CACHE_FILE_ENV = 'CMD_CACHE_FILE'
+DEFAULT_MAX_ENTRIES = 1024
+SQLITE_TIMEOUT = 5.0
+STAT_HITS = 'hits'
+STAT_MISSES = 'misses'
+
+_capture_lock = threading.Lock()   # 输出通过文件描述符 1 捕获，同一进程中同时只能捕获一个调用
+
+
+def default_cache_file():
+    """
+    默认的缓存文件。优先使用环境变量 CMD_CACHE_FILE，其次为 $XDG_CACHE_HOME/cmd/results.sqlite3，否则为 ~/.cache/cmd/results.sqlite3
+
+    :return: 缓存文件路径
+    """
+    path = os.environ.get(CACHE_FILE_ENV)
+    if path:
+        return path
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'cmd', 'results.sqlite3')
+
+
+def write_output(output):
+    """
+    将捕获的输出写回标准输出。标准输出已被替换为内存中的对象（如 io.StringIO）时按 utf-8 解码后写入
+
+    :param output: 输出 bytes
+    """
+    sys.stdout.flush()
+    buffer = getattr(sys.stdout, 'buffer', None)
+    if buffer is not None:
+        buffer.write(output)
+    else:
+        sys.stdout.write(output.decode('utf-8', 'replace'))
+    sys.stdout.flush()
+
+
+def capture_output(func):
+    """
+    执行函数并捕获其标准输出，包括子进程直接写入文件描述符 1 的输出。捕获的输出在执行结束后写回标准输出
+
+    :param func: 执行的函数，无参数
+    :return: (函数的返回值, 输出 bytes)，函数抛出异常时输出写回后原样抛出
+    """
+    with _capture_lock:
+        try:
+            stdout_fd = sys.stdout.fileno()
+        except (AttributeError, io.UnsupportedOperation, ValueError):
+            stdout_fd = None
+        if stdout_fd is None:
+            # 标准输出已被替换为内存中的对象，只能捕获 python 中的输出
+            buf = io.StringIO()
+            try:
+                with redirect_stdout(buf):
+                    result = func()
+            finally:
+                output = buf.getvalue().encode('utf-8')
+                sys.stdout.write(buf.getvalue())
+            return result, output
+
+        sys.stdout.flush()
+        saved_fd = os.dup(stdout_fd)
+        with tempfile.TemporaryFile(prefix='cmd_cache_') as tmp:
+            os.dup2(tmp.fileno(), stdout_fd)
+            try:
+                result = func()
+            finally:
+                sys.stdout.flush()
+                os.dup2(saved_fd, stdout_fd)
+                os.close(saved_fd)
+                tmp.seek(0)
+                output = tmp.read()
+                write_output(output)
+        return result, output
+
+
+class ResultCache(object):
+    """
+    子命令结果的缓存，存储在 sqlite3 数据库文件中，多个进程共享。
+    以 (子命令名, 长参名, 参数值) 为key，记录返回值和输出以及过期时间，条目数超过上限时淘汰最久未使用的条目，并统计命中与未命中的次数。
+    返回值以 json 存储，不使用 pickle，读取缓存时不会执行文件中的任何代码
+    """
+
+    def __init__(self, cache_file=None, max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        创建结果缓存
+
+        :param cache_file: 缓存文件路径，为空时使用 default_cache_file。所在目录不存在时以 0700 权限创建，
+                           已存在时必须属于当前用户且权限为 0700，参考 util.ensure_private_dir
+        :param max_entries: 最大条目数
+        """
+        self.__cache_file = cache_file if cache_file else default_cache_file()
+        self.__max_entries = max_entries
+        self.__local = threading.local()    # sqlite3 连接不能跨线程使用，每个线程一个连接
+
+    def __conn(self):
+        conn = getattr(self.__local, 'conn', None)
+        if conn is not None:
+            return conn
+        cache_dir = os.path.dirname(self.__cache_file)
+        if cache_dir:
+            ensure_private_dir(cache_dir)
+        conn = sqlite3.connect(self.__cache_file, timeout=SQLITE_TIMEOUT)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS results (sub_cmd TEXT, opt TEXT, value TEXT, result BLOB, '
+                     'output BLOB, expires REAL, accessed REAL, PRIMARY KEY (sub_cmd, opt, value))')
+        conn.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, count INTEGER)')
+        self.__local.conn = conn
+        return conn
+
+    @staticmethod
+    def __count(conn, name):
+        conn.execute('INSERT INTO stats (name, count) VALUES (?, 1) '
+                     'ON CONFLICT(name) DO UPDATE SET count = count + 1', (name,))
+
+    def get(self, sub_cmd, opt, value):
+        """
+        查找未过期的缓存，并计入命中或未命中的次数
+
+        :param sub_cmd: 子命令名
+        :param opt: 长参名
+        :param value: 参数值
+        :return: (返回值, 输出 bytes)，不存在、已过期或无法解析时返回空。返回值经过 json 转换，如元组变为列表
+        """
+        now = time.time()
+        key = (sub_cmd, opt, json.dumps(value, default=repr))
+        conn = self.__conn()
+        with conn:
+            row = conn.execute('SELECT result, output FROM results WHERE sub_cmd = ? AND opt = ? AND value = ? '
+                               'AND expires > ?', key + (now,)).fetchone()
+            result = None
+            if row is not None:
+                try:
+                    result = json.loads(row[0])
+                except (TypeError, ValueError):
+                    # 旧版本以 pickle 存储的条目，或损坏的条目
+                    conn.execute('DELETE FROM results WHERE sub_cmd = ? AND opt = ? AND value = ?', key)
+                    row = None
+            if row is None:
+                self.__count(conn, STAT_MISSES)
+                return None
+            conn.execute('UPDATE results SET accessed = ? WHERE sub_cmd = ? AND opt = ? AND value = ?', (now,) + key)
+            self.__count(conn, STAT_HITS)
+        return result, row[1]
+
+    def put(self, sub_cmd, opt, value, result, output, ttl):
+        """
+        存储调用的结果，并淘汰过期以及超出条目上限的条目。返回值无法 json 序列化时不缓存
+
+        :param sub_cmd: 子命令名
+        :param opt: 长参名
+        :param value: 参数值
+        :param result: 返回值
+        :param output: 输出 bytes
+        :param ttl: 有效秒数
+        """
+        try:
+            data = json.dumps(result)
+        except (TypeError, ValueError):
+            return
+        now = time.time()
+        conn = self.__conn()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (sub_cmd, opt, json.dumps(value, default=repr), data, output, now + ttl, now))
+            conn.execute('DELETE FROM results WHERE expires <= ?', (now,))
+            conn.execute('DELETE FROM results WHERE rowid IN (SELECT rowid FROM results ORDER BY accessed DESC '
+                         'LIMIT -1 OFFSET ?)', (self.__max_entries,))
+
+    def invalidate(self, sub_cmd=None, opt=None):
+        """
+        删除缓存的结果，如执行了修改状态的参数后使查询状态的结果失效
+
+        :param sub_cmd: 子命令名，为空时删除全部子命令的结果
+        :param opt: 长参名，为空时删除子命令全部参数的结果
+        :return: 删除的条目数
+        """
+        conn = self.__conn()
+        with conn:
+            if sub_cmd is None:
+                cursor = conn.execute('DELETE FROM results')
+            elif opt is None:
+                cursor = conn.execute('DELETE FROM results WHERE sub_cmd = ?', (sub_cmd,))
+            else:
+                cursor = conn.execute('DELETE FROM results WHERE sub_cmd = ? AND opt = ?', (sub_cmd, opt))
+        return cursor.rowcount
+
+    def stats(self):
+        """
+        缓存的统计信息
+
+        :return: dict，hits 为命中次数，misses 为未命中次数，entries 为当前条目数
+        """
+        conn = self.__conn()
+        counts = dict(conn.execute('SELECT name, count FROM stats').fetchall())
+        entries = conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        return {STAT_HITS: counts.get(STAT_HITS, 0), STAT_MISSES: counts.get(STAT_MISSES, 0), 'entries': entries}
+
+    def reset_stats(self):
+        """
+        清零命中与未命中的次数
+        """
+        conn = self.__conn()
+        with conn:
+            conn.execute('DELETE FROM stats')
@@ -0,0 +1,118 @@
+# -*- coding: UTF-8 -*-
+import json
+import os
+import socket
+import struct
+import sys
+import zlib
+
+SOCKET_ENV = 'CMD_SOCKET'
+HEADER_FMT = '!I'
+EXIT_CODE_FMT = '!i'
+
+
+def default_socket_path(scope=''):
+    """
+    默认的守护进程套接字路径。优先使用环境变量 CMD_SOCKET，其次为 $XDG_RUNTIME_DIR/cmd-<scope摘要>.sock，
+    否则为 /tmp/cmd-<uid>-<scope摘要>.sock。不同的安装（如多个 cmd.py 的副本、基于本库的其他工具）使用不同的 scope，
+    调用不会被转发给其他安装的守护进程
+
+    :param scope: 安装的标识，如命令目录的绝对路径
+    :return: 套接字路径
+    """
+    path = os.environ.get(SOCKET_ENV)
+    if path:
+        return path
+    digest = '%08x' % zlib.crc32(scope.encode('utf-8'))
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'cmd-%s.sock' % digest)
+    return '/tmp/cmd-%d-%s.sock' % (os.getuid(), digest)
+
+
+def peer_uid(sock):
+    """
+    获取 Unix 套接字另一端进程的用户 id
+
+    :param sock: 已连接的 Unix 套接字
+    :return: 用户 id，平台不支持 SO_PEERCRED 时返回空
+    """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+
+def is_trusted_peer(sock, socket_path=None):
+    """
+    另一端是否为当前用户的进程。优先使用 SO_PEERCRED，平台不支持时检查套接字文件的属主
+
+    :param sock: 已连接的 Unix 套接字
+    :param socket_path: 套接字路径，平台不支持 SO_PEERCRED 时使用
+    :return: 属于当前用户时返回 True
+    """
+    uid = peer_uid(sock)
+    if uid is None:
+        if socket_path is None:
+            return False
+        uid = os.stat(socket_path).st_uid
+    return uid == os.getuid()
+
+
+def recv_exactly(sock, size):
+    """
+    从套接字中读取指定长度的数据
+
+    :param sock: 套接字
+    :param size: 读取的字节数
+    :return: 读取的数据，连接提前关闭时返回空
+    """
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            return None
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def call(argv, socket_path=None):
+    """
+    将命令行参数转发给守护进程执行。当前进程的标准输入、输出、错误通过套接字传递给守护进程，
+    子命令的输出直接写入当前进程的终端或管道，不经过转发。
+    该模块只依赖标准库中的少量模块，避免客户端产生额外的加载开销
+
+    :param argv: 命令行参数 sys.argv
+    :param socket_path: 守护进程的套接字路径，为空时使用 default_socket_path
+    :return: 子命令的退出码。守护进程不存在、无法连接（如套接字路径过长、连接被重置）、不属于当前用户，
+             或标准输入输出无法传递（如已关闭）时返回空，调用方应退回到当前进程中执行
+    """
+    if socket_path is None:
+        socket_path = default_socket_path()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        # 请求完整发送之前守护进程不会执行子命令，此前的任何错误都可以安全地退回到当前进程中执行
+        try:
+            sock.connect(socket_path)
+            # 套接字可能由其他用户预先创建，不能将环境变量和终端交给其他用户的进程
+            if not is_trusted_peer(sock, socket_path):
+                print('Ignoring command server on %s: not owned by uid %d' % (socket_path, os.getuid()),
+                      file=sys.stderr)
+                return None
+            payload = json.dumps({'argv': list(argv), 'cwd': os.getcwd(), 'env': dict(os.environ)}).encode('utf-8')
+            fds = [sys.stdin.fileno(), sys.stdout.fileno(), sys.stderr.fileno()]
+            sys.stdout.flush()
+            sys.stderr.flush()
+            socket.send_fds(sock, [struct.pack(HEADER_FMT, len(payload))], fds)
+            sock.sendall(payload)
+        except (OSError, ValueError, AttributeError):
+            return None
+        try:
+            reply = recv_exactly(sock, struct.calcsize(EXIT_CODE_FMT))
+        except OSError:
+            reply = None
+        if reply is None:
+            return 1
+        return struct.unpack(EXIT_CODE_FMT, reply)[0]
+    finally:
+        sock.close()
@@ -0,0 +1,134 @@
+# -*- coding: UTF-8 -*-
+import os
+import shlex
+import sys
+
+from util.cmd_loader import CmdLoader
+
+COMPLETION_SHELLS = ('bash', 'zsh')
+
+BASH_TEMPLATE = r'''# bash completion for {prog_name}, generated by: {prog_name} --completion bash
+_{func}_index() {{
+    local idx={index_file}
+    if [[ ! -f $idx || -n $(find {watch_dirs} -newer "$idx" \( -name '*{file_suffix}' -o -type d \) -print -quit 2>/dev/null) ]]; then
+        {rebuild} >/dev/null 2>&1
+    fi
+    printf '%s' "$idx"
+}}
+
+_{func}() {{
+    local cur=${{COMP_WORDS[COMP_CWORD]}} prev=${{COMP_WORDS[COMP_CWORD-1]}} idx line
+    idx=$(_{func}_index)
+    [[ -f $idx ]] || return
+    if (( COMP_CWORD == 1 )); then
+        COMPREPLY=( $(compgen -W "$(cut -d' ' -f1 "$idx")" -- "$cur") )
+        return
+    fi
+    line=$(awk -v n="${{COMP_WORDS[1]}}" '$1 == n {{ print; exit }}' "$idx")
+    [[ -n $line ]] || return
+    if [[ " $line " == *" $prev= "* ]]; then
+        compopt -o default
+        COMPREPLY=()
+        return
+    fi
+    line=${{line#* }}
+    COMPREPLY=( $(compgen -W "${{line//=/}}" -- "$cur") )
+}}
+complete -F _{func} {prog_name}
+'''
+
+ZSH_TEMPLATE = r'''#compdef {prog_name}
+# zsh completion for {prog_name}, generated by: {prog_name} --completion zsh
+_{func}() {{
+    local idx={index_file}
+    if [[ ! -f $idx || -n $(find {watch_dirs} -newer "$idx" \( -name '*{file_suffix}' -o -type d \) -print -quit 2>/dev/null) ]]; then
+        {rebuild} >/dev/null 2>&1
+    fi
+    [[ -f $idx ]] || return 1
+    if (( CURRENT == 2 )); then
+        local -a subs
+        subs=(${{(f)"$(cut -d' ' -f1 $idx)"}})
+        compadd -a subs
+        return
+    fi
+    local line=$(awk -v n="${{words[2]}}" '$1 == n {{ print; exit }}' $idx)
+    [[ -n $line ]] || return 1
+    local -a opts
+    opts=(${{=line}})
+    shift opts
+    if (( ${{opts[(Ie)${{words[CURRENT-1]}}=]}} )); then
+        _files
+        return
+    fi
+    compadd -- ${{opts%=}}
+}}
+compdef _{func} {prog_name}
+'''
+
+
+def index_lines(specs):
+    """
+    生成补全索引的内容。每个子命令一行，以空格分隔子命令名与全部参数名，需要参数值的参数名以 = 结尾，如：
+
+        network -h --help -s --start -c= --config=
+
+    :param specs: (子命令名, 参数对象元组) 的列表
+    :return: 索引的行的列表
+    """
+    lines = []
+    for name, args in specs:
+        if not name or ' ' in name:
+            continue
+        opts = [name, '-h', '--help']
+        for arg in args:
+            suffix = '=' if arg.need_value else ''
+            if arg.short_name:
+                opts.append(arg.short_name + suffix)
+            if arg.long_name:
+                opts.append(arg.long_name + suffix)
+        lines.append(' '.join(opts))
+    return lines
+
+
+def write_index(loader: CmdLoader, index_file):
+    """
+    生成补全索引文件。参数定义来自 CmdLoader.cmd_specs，加载器使用清单缓存时只会加载修改过的子命令模块。
+    先写入临时文件再替换，补全脚本不会读取到不完整的文件
+
+    :param loader: 已调用过 load 的子命令加载器
+    :param index_file: 索引文件路径
+    :return: 子命令个数
+    """
+    lines = index_lines(loader.cmd_specs())
+    tmp_file = '%s.%d.tmp' % (index_file, os.getpid())
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        for line in lines:
+            f.write(line + '\n')
+    os.replace(tmp_file, index_file)
+    return len(lines)
+
+
+def completion_script(shell, prog, index_file, watch_dirs, file_suffix='_cmd.py', python=None):
+    """
+    生成补全脚本。补全时只读取索引文件，不启动 python；
+    索引文件不存在，或 watch_dirs 中有比索引更新的子命令文件、目录时，先执行 <prog> --completion-index 重新生成索引
+
+    :param shell: bash 或 zsh
+    :param prog: cmd.py 的绝对路径
+    :param index_file: 索引文件的绝对路径
+    :param watch_dirs: 子命令所在的目录
+    :param file_suffix: 子命令文件的后缀
+    :param python: 重新生成索引时使用的 python，为空时为当前的 python
+    :return: 脚本内容
+    """
+    if shell not in COMPLETION_SHELLS:
+        raise ValueError('Unsupported shell: %s' % shell)
+    prog_name = os.path.basename(prog)
+    template = BASH_TEMPLATE if shell == 'bash' else ZSH_TEMPLATE
+    rebuild = ' '.join(shlex.quote(s) for s in [python or sys.executable, prog, '--completion-index'])
+    return template.format(prog_name=prog_name,
+                           func=''.join(c if c.isalnum() else '_' for c in prog_name),
+                           index_file=shlex.quote(index_file),
+                           watch_dirs=' '.join(shlex.quote(d) for d in watch_dirs),
+                           file_suffix=file_suffix,
+                           rebuild=rebuild)
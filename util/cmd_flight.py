@@ -0,0 +1,158 @@
+# -*- coding: UTF-8 -*-
+import fcntl
+import hashlib
+import json
+import os
+import uuid
+
+from command import COALESCE_SKIP, COALESCE_WAIT
+from util import CommandException, ensure_private_dir
+
+FLIGHT_DIR_ENV = 'CMD_FLIGHT_DIR'
+STATUS_OK = 'ok'
+STATUS_ERROR = 'error'
+
+
+def default_flight_dir():
+    """
+    默认的锁文件目录。优先使用环境变量 CMD_FLIGHT_DIR，其次为 $XDG_RUNTIME_DIR/cmd-flight，否则为 /tmp/cmd-flight-<uid>
+
+    :return: 目录路径
+    """
+    path = os.environ.get(FLIGHT_DIR_ENV)
+    if path:
+        return path
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'cmd-flight')
+    return '/tmp/cmd-flight-%d' % os.getuid()
+
+
+class SingleFlight(object):
+    """
+    跨进程合并相同的调用。每个调用（子命令、参数、参数值）对应目录中的一个锁文件，
+    获得排他锁的进程执行调用，并将结果写入结果文件；其他进程按策略等待并读取结果，或直接跳过。
+    锁由 fcntl.flock 实现，进程退出（包括崩溃）时自动释放
+    """
+
+    def __init__(self, flight_dir=None):
+        """
+        创建合并器
+
+        :param flight_dir: 锁文件与结果文件的目录，为空时使用 default_flight_dir，目录不存在时以 0700 权限创建，
+                           已存在时必须属于当前用户且权限为 0700，否则执行时抛出 InsecurePathError
+        """
+        self.__flight_dir = flight_dir if flight_dir else default_flight_dir()
+
+    def __paths(self, key):
+        """
+        调用对应的锁文件与结果文件路径
+
+        :param key: 调用的标识，可 json 序列化
+        :return: (锁文件路径, 结果文件路径)
+        """
+        digest = hashlib.sha1(json.dumps(key, default=repr).encode('utf-8')).hexdigest()
+        path = os.path.join(self.__flight_dir, digest)
+        return path + '.lock', path + '.result'
+
+    @staticmethod
+    def __write_result(result_file, token, status, value):
+        """
+        写入执行结果。结果以 json 存储，不使用 pickle，读取结果时不会执行文件中的任何代码。
+        异常只记录类名与信息；无法 json 序列化的返回值记录为空，与其退出码一致（非 int 的返回值退出码均为 0）
+        """
+        if status == STATUS_ERROR:
+            value = '%s: %s' % (type(value).__name__, value)
+        try:
+            data = json.dumps([token, status, value])
+        except (TypeError, ValueError):
+            data = json.dumps([token, status, None])
+        tmp_file = '%s.%d.tmp' % (result_file, os.getpid())
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_file, result_file)
+        except OSError:
+            # 结果写入失败时等待的进程会自己执行，不影响当前调用
+            pass
+
+    @staticmethod
+    def __read_result(result_file, token):
+        """
+        读取指定执行的结果
+
+        :return: (状态, 返回值或异常信息)，结果不存在或不属于该次执行时返回空
+        """
+        try:
+            with open(result_file, 'r', encoding='utf-8') as f:
+                result_token, status, value = json.load(f)
+        except (OSError, ValueError, TypeError):
+            return None
+        if result_token != token or status not in (STATUS_OK, STATUS_ERROR):
+            return None
+        return status, value
+
+    @staticmethod
+    def __token(lock_fd):
+        return os.pread(lock_fd, 64, 0).decode('ascii', 'ignore')
+
+    def __lead(self, lock_fd, result_file, func):
+        """
+        已获得排他锁，执行调用并记录结果，结果写入后才释放锁
+        """
+        token = uuid.uuid4().hex
+        os.ftruncate(lock_fd, 0)
+        os.pwrite(lock_fd, token.encode('ascii'), 0)
+        try:
+            result = func()
+        except Exception as e:
+            self.__write_result(result_file, token, STATUS_ERROR, e)
+            raise
+        self.__write_result(result_file, token, STATUS_OK, result)
+        return result
+
+    def run(self, key, policy, func):
+        """
+        执行调用。没有相同的调用在执行时直接执行；否则 COALESCE_WAIT 等待其结束并返回其返回值，
+        或抛出带有其异常类名与信息的 CommandException，
+        COALESCE_SKIP 不执行并返回空。正在执行的进程异常退出而未留下结果时，等待的进程自己执行
+
+        :param key: 调用的标识，可 json 序列化，如 (子命令名, 长参名, 参数值)
+        :param policy: 合并策略 COALESCE_WAIT 或 COALESCE_SKIP
+        :param func: 执行调用的函数，无参数
+        :return: 函数的返回值
+        """
+        if policy not in (COALESCE_WAIT, COALESCE_SKIP):
+            return func()
+        ensure_private_dir(self.__flight_dir)
+        lock_file, result_file = self.__paths(key)
+        lock_fd = os.open(lock_file, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                in_flight = False
+            except BlockingIOError:
+                in_flight = True
+            if not in_flight:
+                return self.__lead(lock_fd, result_file, func)
+            if policy == COALESCE_SKIP:
+                return None
+
+            # 共享锁在执行的进程释放排他锁后才能获得，此时锁文件中为该次执行的标识
+            fcntl.flock(lock_fd, fcntl.LOCK_SH)
+            token = self.__token(lock_fd)
+            shared = self.__read_result(result_file, token)
+            if shared is None:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)
+                # 等待排他锁期间可能已有其他等待的进程执行完成
+                retry_token = self.__token(lock_fd)
+                if retry_token != token:
+                    shared = self.__read_result(result_file, retry_token)
+                if shared is None:
+                    return self.__lead(lock_fd, result_file, func)
+            status, value = shared
+            if status == STATUS_ERROR:
+                raise CommandException(value)
+            return value
+        finally:
+            os.close(lock_fd)
@@ -1,15 +1,29 @@
 # -*- coding: UTF-8 -*-
 import getopt
-import re
+import shlex
 import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from collections.abc import Coroutine, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 
 from command import Cmd
-from util import CommandNotFoundError, CmdHelper
+from util import CommandNotFoundError, CmdHelper, InsufficientParametersError, InvalidParameterError, OptResult, \
+    results_exit_code
 from util.cmd_loader import CmdLoader
 
 USAGE_HEAD = 'Run command.\ncmd.py <sub-command> <argv>'
 USAGE_SUBCMD_FMT = "\n{0}:"
 USAGE_ARG_FMT = "\n{0:>4}, {1:<12}{2}"
+BATCH_PROG = 'cmd.py'
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_ASYNC_LIMIT = 8
+DEFAULT_SUGGESTIONS = 5
+PIPE_SEPARATOR = '::'
 
 
 class DefaultCmdHelper(CmdHelper):
@@ -19,42 +33,110 @@ class DefaultCmdHelper(CmdHelper):
 
     def __init__(self):
         self.__usage_head = USAGE_HEAD # 帮助的顶部信息
-        self.__usage = ''   # 完整的帮助
+        self.__usage = None   # 完整的帮助，不含顶部信息，在首次获取时渲染
         self.__subcmd = {}  # 子命令实例，key为子命令名，value为实例
-        self.__subcmd_short_opts = {}   # 子命令短参名，key为子命令名，value为短参名
-        self.__subcmd_long_opts = {}    # 子命令长参名，key为子命令名，value为长参名
-        self.__subcmd_usage = {}       # 子命令帮助，key为子命令名，value为帮助信息
+        self.__subcmd_handlers = {}  # 子命令参数的处理函数，key为子命令名，value为参数名到处理函数的映射
+        self.__subcmd_args = OrderedDict()  # 子命令参数定义，key为子命令名，value为参数对象元组
+        self.__subcmd_short_opts = {}   # 子命令短参名，key为子命令名，value为短参名，在首次获取时生成
+        self.__subcmd_long_opts = {}    # 子命令长参名，key为子命令名，value为长参名，在首次获取时生成
+        self.__subcmd_usage = {}       # 子命令帮助，key为子命令名，value为帮助信息，在首次获取时渲染
+        self.__subcmd_parsers = {}  # 子命令的参数解析器，key为子命令名，value为 CmdParser，在首次获取时编译
         self.__cmd_loader = None    # 命令加载器
+        self.__lock = threading.RLock()  # 批量并发执行时保护子命令的按需加载
+        self.__subcmd_opt_args = {}  # 子命令的参数对象，key为子命令名，value为短参名、长参名到参数对象的映射
+        self.__max_workers = DEFAULT_MAX_WORKERS   # 同一次调用中并发执行参数的线程数
+        self.__executor = None  # 执行参数的后端，如 CmdWorkerPool，为空时在当前进程中执行
+        self.__single_flight = None  # 跨进程合并相同调用的 SingleFlight，在首次需要合并时创建
+        self.__result_cache = None  # 参数结果的缓存 ResultCache，在首次需要缓存时创建
+        self.__subcmd_trie = None   # 子命令名的前缀树，在首次遇到非完整的子命令名时创建
+        self.__metrics = None   # 执行指标 CmdMetrics，为空时不记录
+        self.__concurrency = 0  # 正在进行的并发执行数，大于 0 时未命中缓存的结果不写入缓存
 
-    def __assemble_help_cmd(self, subcmd_name):
+    def __render_subcmd_usage(self, subcmd_name):
+        """
+        渲染子命令的帮助，渲染结果会被缓存
+
+        :param subcmd_name: 子命令名，必须已组装
+        :return: 子命令帮助，不含顶部信息
+        """
         if subcmd_name in self.__subcmd_usage:
-            return
-        self.__usage = self.__usage_head + USAGE_SUBCMD_FMT.format(subcmd_name)
-        self.__subcmd_usage[subcmd_name] = USAGE_SUBCMD_FMT.format(subcmd_name)
+            return self.__subcmd_usage[subcmd_name]
+        lines = [USAGE_SUBCMD_FMT.format(subcmd_name)]
+        for arg in self.__subcmd_args[subcmd_name]:
+            lines.append(USAGE_ARG_FMT.format(arg.short_name, arg.long_name, arg.description))
+        usage = ''.join(lines)
+        self.__subcmd_usage[subcmd_name] = usage
+        return usage
 
-    def __assemble_help_arg(self, subcmd_name, short_arg, long_arg, desc):
-        if subcmd_name not in self.__subcmd_usage:
+    def __assemble_subcmd_opts(self, subcmd_name):
+        """
+        生成子命令的短参名与长参名，生成结果会被缓存
+
+        :param subcmd_name: 子命令名，必须已组装
+        """
+        if subcmd_name in self.__subcmd_short_opts:
             return
-        self.__usage += USAGE_ARG_FMT.format(short_arg, long_arg, desc)
-        self.__subcmd_usage[subcmd_name] += USAGE_ARG_FMT.format(short_arg, long_arg, desc)
-
-    def __assemble_subcmd_opts(self, subcmd_name, short_arg, long_arg, need_val):
-        if subcmd_name not in self.__subcmd_short_opts:
-            self.__subcmd_short_opts[subcmd_name] = 'h'
-        if subcmd_name not in self.__subcmd_long_opts:
-            self.__subcmd_long_opts[subcmd_name] = ['help']
-
-        if need_val:
-            self.__subcmd_short_opts[subcmd_name] += short_arg[1:] + ':'
-            self.__subcmd_long_opts[subcmd_name].append(long_arg[2:] + '=')
-        else:
-            self.__subcmd_short_opts[subcmd_name] += short_arg[1:]
-            self.__subcmd_long_opts[subcmd_name].append(long_arg[2:])
+        short_opts = ['h']
+        long_opts = ['help']
+        for arg in self.__subcmd_args[subcmd_name]:
+            if arg.need_value:
+                short_opts.append(arg.short_name[1:] + ':')
+                long_opts.append(arg.long_name[2:] + '=')
+            else:
+                short_opts.append(arg.short_name[1:])
+                long_opts.append(arg.long_name[2:])
+        self.__subcmd_short_opts[subcmd_name] = ''.join(short_opts)
+        self.__subcmd_long_opts[subcmd_name] = long_opts
 
     def __assemble_cmd(self, subcmd, cmd: Cmd):
         if not subcmd:
             return
         self.__subcmd[subcmd] = cmd
+        self.__subcmd_handlers[subcmd] = cmd.handlers()
+
+    def __assemble_subcmd(self, sub_cmd_name, args):
+        """
+        记录单个子命令的参数定义，已组装的子命令将被忽略。帮助与参数名在使用时才生成
+
+        :param sub_cmd_name: 子命令名
+        :param args: 子命令的参数对象元组
+        """
+        if not sub_cmd_name or sub_cmd_name in self.__subcmd_args:
+            return
+        if not isinstance(args, tuple):
+            return
+        self.__subcmd_args[sub_cmd_name] = args
+        self.__usage = None
+
+    def __assemble_all(self):
+        """
+        组装全部子命令，加载器无法直接提供参数定义时会加载全部模块
+
+        :return: 全部子命令名，按加载器中的顺序
+        """
+        names = []
+        for sub_cmd_name, args in self.__cmd_loader.cmd_specs():
+            self.__assemble_subcmd(sub_cmd_name, args)
+            names.append(sub_cmd_name)
+        return names
+
+    def __ensure_subcmd(self, sub_cmd):
+        """
+        确保子命令的参数定义已组装，参数定义由加载器提供，不一定需要创建子命令实例
+
+        :param sub_cmd: 子命令名
+        :return: 子命令存在返回 True，否则返回 False
+        """
+        if not sub_cmd:
+            return False
+        if sub_cmd in self.__subcmd_args:
+            return True
+        with self.__lock:
+            args = self.__cmd_loader.cmd_args(sub_cmd)
+            if args is None:
+                return False
+            self.__assemble_subcmd(sub_cmd, args)
+            return sub_cmd in self.__subcmd_args
 
     def set_usage_head(self, usage_head):
         """
@@ -67,6 +149,91 @@ class DefaultCmdHelper(CmdHelper):
             self.__usage_head = usage_head
         return self
 
+    def set_max_workers(self, max_workers):
+        """
+        设置同一次调用中并发执行参数的线程数，默认为 DEFAULT_MAX_WORKERS
+
+        :param max_workers: 线程数，必须大于 0
+        :return: 当前对象，允许链式调用
+        """
+        if isinstance(max_workers, int) and max_workers > 0:
+            self.__max_workers = max_workers
+        return self
+
+    def set_executor(self, executor):
+        """
+        设置执行参数的后端，设置后 run、run_all 通过后端的 execute(sub_cmd, opt, value) 执行参数，
+        如 util.cmd_pool.CmdWorkerPool 在独立的工作进程中执行。execute 方法本身始终在当前进程中执行
+
+        :param executor: 执行后端，为空时恢复为在当前进程中执行
+        :return: 当前对象，允许链式调用
+        """
+        self.__executor = executor
+        return self
+
+    def set_single_flight(self, single_flight):
+        """
+        设置合并相同调用的 util.cmd_flight.SingleFlight，默认在首次需要合并时以默认的锁文件目录创建
+
+        :param single_flight: SingleFlight 对象
+        :return: 当前对象，允许链式调用
+        """
+        self.__single_flight = single_flight
+        return self
+
+    def set_result_cache(self, result_cache):
+        """
+        设置声明了 cache_ttl 的参数使用的 util.cmd_cache.ResultCache，默认在首次需要缓存时以默认的缓存文件创建
+
+        :param result_cache: ResultCache 对象
+        :return: 当前对象，允许链式调用
+        """
+        self.__result_cache = result_cache
+        return self
+
+    def result_cache(self):
+        """
+        获取结果缓存，用于使缓存失效或查看命中次数
+
+        :return: ResultCache 对象
+        """
+        if self.__result_cache is None:
+            from util.cmd_cache import ResultCache
+            self.__result_cache = ResultCache()
+        return self.__result_cache
+
+    def set_metrics(self, metrics):
+        """
+        设置执行指标 util.cmd_metrics.CmdMetrics，设置后 run、run_all 记录每个参数的执行次数、失败次数与耗时
+
+        :param metrics: CmdMetrics 对象，为空时不记录
+        :return: 当前对象，允许链式调用
+        """
+        self.__metrics = metrics
+        return self
+
+    def metrics(self):
+        """
+        获取执行指标
+
+        :return: CmdMetrics，未设置时返回空
+        """
+        return self.__metrics
+
+    @contextmanager
+    def concurrently(self):
+        """
+        标记 with 块中的参数会并发执行。捕获输出需要重定向整个进程的文件描述符 1，
+        并发时其他调用的输出会混入，因此 with 块中只使用已缓存的结果，未命中时直接执行且不写入缓存
+        """
+        with self.__lock:
+            self.__concurrency += 1
+        try:
+            yield self
+        finally:
+            with self.__lock:
+                self.__concurrency -= 1
+
     def set_cmd_loader(self, cmd_loader: CmdLoader):
         """
         设置命令实现的加载器，加载器必须是一个CmdLoader的实现，提供了两种默认的加载器实现ModuleFileCmdLoader, SimpleCmdLoader
@@ -84,10 +251,14 @@ class DefaultCmdHelper(CmdHelper):
         :param subcmd: 子命令的名称
         :return: 若参数subcmd为空，则返回完整的帮助，否则只返回subcmd指定的子命令帮助
         """
-        if subcmd and self.__subcmd_usage[subcmd]:
-            print(self.__usage_head + self.__subcmd_usage[subcmd])
+        if subcmd and self.__ensure_subcmd(subcmd):
+            print(self.__usage_head + self.__render_subcmd_usage(subcmd))
             return
-        print(self.__usage)
+        if self.__usage is None:
+            names = self.__assemble_all()
+            self.__usage = ''.join([self.__render_subcmd_usage(name) for name in names
+                                    if name in self.__subcmd_args])
+        print(self.__usage_head + self.__usage)
 
     def short_opts(self, subcmd):
         """
@@ -96,6 +267,9 @@ class DefaultCmdHelper(CmdHelper):
         :param subcmd: 子命令的名称
         :return: 短参数名，若子命令不存在则返回空
         """
+        if not self.__ensure_subcmd(subcmd):
+            return None
+        self.__assemble_subcmd_opts(subcmd)
         return self.__subcmd_short_opts[subcmd]
 
     def long_opts(self, subcmd):
@@ -105,43 +279,617 @@ class DefaultCmdHelper(CmdHelper):
         :param subcmd: 子命令的名称
         :return: 长参数名，若子命令不存在则返回空
         """
+        if not self.__ensure_subcmd(subcmd):
+            return None
+        self.__assemble_subcmd_opts(subcmd)
         return self.__subcmd_long_opts[subcmd]
 
+    def parser(self, subcmd):
+        """
+        获取子命令的参数解析器，解析器在首次获取时由参数定义编译，之后的解析无需再次编译
+
+        :param subcmd: 子命令的名称
+        :return: util.cmd_parser.CmdParser，若子命令不存在则返回空
+        """
+        parser = self.__subcmd_parsers.get(subcmd)
+        if parser is not None:
+            return parser
+        if not self.__ensure_subcmd(subcmd):
+            return None
+        from util.cmd_parser import CmdParser
+        parser = CmdParser(self.__subcmd_args[subcmd])
+        self.__subcmd_parsers[subcmd] = parser
+        return parser
+
     def assemble(self):
         """
-        加载指令类，并组装帮助信息
+        加载指令类，并组装帮助信息。若加载器为懒加载模式，子命令在使用时才组装
         """
-        self.__cmd_loader.load()
-        for cmd in self.__cmd_loader.cmd_instances():
-            sub_cmd_name = cmd.name()
-            self.__assemble_cmd(sub_cmd_name, cmd)
-            args = cmd.args()
-            if not isinstance(args, tuple):
+        with self.profiler().phase('assemble'):
+            self.__cmd_loader.load()
+            if self.__cmd_loader.is_lazy():
                 return
-            self.__assemble_help_cmd(sub_cmd_name)
-            for arg in args:
-                self.__assemble_help_arg(sub_cmd_name, arg.short_name, arg.long_name, arg.description)
-                self.__assemble_subcmd_opts(sub_cmd_name, arg.short_name, arg.long_name, arg.need_value)
+            self.__assemble_all()
+
+    def reload(self):
+        """
+        增量重新加载子命令，只更新加载器报告的新增、修改和删除的子命令，其他子命令的实例、帮助和参数名保持不变
+
+        :return: (新增的子命令名, 修改的子命令名, 删除的子命令名)，均为集合
+        """
+        with self.__lock:
+            added, changed, removed = self.__cmd_loader.reload()
+            for sub_cmd in added | changed | removed:
+                self.__subcmd.pop(sub_cmd, None)
+                self.__subcmd_handlers.pop(sub_cmd, None)
+                self.__subcmd_args.pop(sub_cmd, None)
+                self.__subcmd_opt_args.pop(sub_cmd, None)
+                self.__subcmd_short_opts.pop(sub_cmd, None)
+                self.__subcmd_long_opts.pop(sub_cmd, None)
+                self.__subcmd_parsers.pop(sub_cmd, None)
+                self.__subcmd_usage.pop(sub_cmd, None)
+            if added or changed or removed:
+                self.__usage = None
+                self.__subcmd_trie = None
+        return added, changed, removed
+
+    def __trie(self):
+        """
+        子命令名的前缀树，子命令名来自加载器，懒加载时无需加载模块
+
+        :return: CmdTrie
+        """
+        if self.__subcmd_trie is not None:
+            return self.__subcmd_trie
+        from util.cmd_trie import CmdTrie
+        with self.__lock:
+            if self.__subcmd_trie is None:
+                self.__subcmd_trie = CmdTrie(self.__cmd_loader.cmd_names())
+            return self.__subcmd_trie
+
+    def resolve_subcmd(self, name):
+        """
+        将命令行中的子命令名解析为完整的子命令名，接受唯一的前缀，如 net 解析为 network
+
+        :param name: 命令行中的子命令名
+        :return: 完整的子命令名，不存在或前缀不唯一时返回空
+        """
+        if not name:
+            return None
+        if name in self.__subcmd_args:
+            return name
+        # 先在前缀树中查找，缩写和拼写错误都不会加载任何子命令模块
+        resolved = self.__trie().resolve(name)
+        if resolved is not None:
+            return resolved if self.__ensure_subcmd(resolved) else None
+        # 懒加载且未设置清单缓存时，索引中是文件名，子命令名可能与之不一致，由加载器查找
+        return name if self.__ensure_subcmd(name) else None
+
+    def suggest_subcmds(self, name):
+        """
+        与未知的子命令名相近的子命令名：编辑距离不超过 2 的子命令名，以及以其为前缀的子命令名
+
+        :param name: 未知的子命令名
+        :return: 子命令名的列表，越相近越靠前
+        """
+        if not name:
+            return []
+        trie = self.__trie()
+        suggestions = trie.suggest(name)
+        for candidate in trie.starts_with(name, DEFAULT_SUGGESTIONS):
+            if candidate not in suggestions:
+                suggestions.append(candidate)
+        return suggestions[:DEFAULT_SUGGESTIONS]
 
     def __find_subcmd(self, sub_cmd):
         if not sub_cmd:
             return None
         if sub_cmd in self.__subcmd:
             return self.__subcmd[sub_cmd]
-        return None
+        with self.__lock:
+            if sub_cmd in self.__subcmd:
+                return self.__subcmd[sub_cmd]
+            cmd = self.__cmd_loader.cmd_instance(sub_cmd)
+            if not cmd:
+                return None
+            self.__assemble_cmd(sub_cmd, cmd)
+            return cmd
 
-    def run(self, sub_cmd, opt, value):
+    def __opt_arg(self, sub_cmd, opt):
+        """
+        通过参数名查找子命令的参数对象
+
+        :param sub_cmd: 子命令名，必须已组装
+        :param opt: 短参名或长参名
+        :return: 参数对象 CmdArg，不存在时返回空
+        """
+        opt_args = self.__subcmd_opt_args.get(sub_cmd)
+        if opt_args is None:
+            opt_args = {}
+            for arg in self.__subcmd_args[sub_cmd]:
+                opt_args[arg.short_name] = arg
+                opt_args[arg.long_name] = arg
+            self.__subcmd_opt_args[sub_cmd] = opt_args
+        return opt_args.get(opt)
+
+    def resolve(self, sub_cmd, opt):
+        """
+        获取参数的处理函数，参数未绑定处理函数时为子命令的 exec
+
+        :param sub_cmd: 子命令名
+        :param opt: 参数名，传入的可能是短参名也可能是长参名
+        :return: 接收参数值作为唯一参数的可调用对象
+        """
         cmd = self.__find_subcmd(sub_cmd)
         if not cmd:
-            raise (CommandNotFoundError, "Can not found command: %s" % sub_cmd)
-        if opt:
-            if re.match(r'-\w+', opt):
-                cmd.exec(opt, None, value)
-                return True
-            elif re.match(r'--\w+', opt):
-                cmd.exec(None, opt, value)
-                return True
+            raise CommandNotFoundError("Can not found command: %s" % sub_cmd)
+        handler = self.__subcmd_handlers[sub_cmd].get(opt)
+        if handler:
+            return handler
+        if opt and opt.startswith('--'):
+            return partial(cmd.exec, None, opt)
+        if opt and opt.startswith('-'):
+            return partial(cmd.exec, opt, None)
+        raise InvalidParameterError("Invalid option: %s" % opt)
+
+    def execute(self, sub_cmd, opt, value, records=None):
+        """
+        运行子命令中的一个参数，并返回处理函数或 exec 的返回值。
+        处理函数为协程函数（如 AsyncCmd 中的 exec）时，在新的事件循环中运行至结束
+
+        :param sub_cmd: 子命令名
+        :param opt: 参数名，传入的可能是短参名也可能是长参名
+        :param value: 参数值
+        :param records: 管道中上一个子命令输出的记录（可迭代对象），以关键字参数 records 传给处理函数或 exec，为空时不传
+        :return: 处理函数或 exec 的返回值
+        """
+        func = self.resolve(sub_cmd, opt)
+        if records is not None and not accepts_records(func):
+            raise InvalidParameterError('%s %s does not accept records from the previous stage' % (sub_cmd, opt))
+        with self.profiler().phase('exec', '%s %s' % (sub_cmd, opt)):
+            result = func(value) if records is None else func(value, records=records)
+            if isinstance(result, Coroutine):
+                import asyncio
+                result = asyncio.run(result)
+        return result
+
+    async def execute_async(self, sub_cmd, opt, value, executor=None):
+        """
+        execute 的异步版本。处理函数为协程函数时直接等待，普通函数在线程池中运行，不阻塞事件循环
+
+        :param sub_cmd: 子命令名
+        :param opt: 参数名，传入的可能是短参名也可能是长参名
+        :param value: 参数值
+        :param executor: 运行普通函数的线程池，为空时使用事件循环默认的线程池
+        :return: 处理函数或 exec 的返回值
+        """
+        import asyncio
+        import inspect
+
+        func = self.resolve(sub_cmd, opt)
+        with self.profiler().phase('exec', '%s %s' % (sub_cmd, opt)):
+            if inspect.iscoroutinefunction(func):
+                return await func(value)
+            result = await asyncio.get_running_loop().run_in_executor(executor, func, value)
+            if isinstance(result, Coroutine):
+                result = await result
+            return result
+
+    def __coalesce_policy(self, sub_cmd, opt):
+        """
+        参数的合并策略，CmdArg 中未声明时使用子命令类中的 cmd_coalesce
+
+        :return: (合并策略, 参数对象)，策略可能为空
+        """
+        arg = self.__opt_arg(sub_cmd, opt) if self.__ensure_subcmd(sub_cmd) else None
+        if arg is not None and arg.coalesce:
+            return arg.coalesce, arg
+        cmd = self.__find_subcmd(sub_cmd)
+        return (type(cmd).cmd_coalesce if cmd else None), arg
+
+    def __long_opt(self, sub_cmd, opt):
+        """
+        参数的长参名，参数不存在或没有长参名时为 opt 本身
+        """
+        arg = self.__opt_arg(sub_cmd, opt) if self.__ensure_subcmd(sub_cmd) else None
+        return arg.long_name if arg is not None and arg.long_name else opt
+
+    def __execute_opt(self, sub_cmd, opt, value, records=None):
+        """
+        通过执行后端运行一个参数，未设置后端时即 execute。
+        参数声明了 cache_ttl 时优先返回缓存的结果；声明了合并策略时，跨进程合并相同的调用。
+        设置了执行指标时记录参数的耗时，以及是否抛出异常或返回非 0 的退出码；
+        记录的开销包括执行结束后的计时、查找长参名以及 CmdMetrics.observe 本身，不包括参数的执行
+        """
+        if self.__metrics is None:
+            return self.__execute_opt_unmeasured(sub_cmd, opt, value, records)
+        failed = True
+        start = time.perf_counter()
+        try:
+            result = self.__execute_opt_unmeasured(sub_cmd, opt, value, records)
+            failed = self.__metrics.is_failure(result)
+            return result
+        finally:
+            end = time.perf_counter()
+            self.__metrics.observe(sub_cmd, self.__long_opt(sub_cmd, opt), end - start, failed,
+                                   overhead=time.perf_counter() - end)
+
+    async def __execute_opt_async(self, sub_cmd, opt, value):
+        """
+        __execute_opt 的异步版本。设置了执行后端，或参数声明了合并策略、cache_ttl 时，在线程池中运行 __execute_opt；
+        否则直接等待 execute_async，并同样记录执行指标
+        """
+        policy, arg = self.__coalesce_policy(sub_cmd, opt)
+        if self.__executor is not None or policy or (arg is not None and arg.cache_ttl):
+            import asyncio
+            return await asyncio.get_running_loop().run_in_executor(None, self.__execute_opt, sub_cmd, opt, value)
+        if self.__metrics is None:
+            return await self.execute_async(sub_cmd, opt, value)
+        failed = True
+        start = time.perf_counter()
+        try:
+            result = await self.execute_async(sub_cmd, opt, value)
+            failed = self.__metrics.is_failure(result)
+            return result
+        finally:
+            end = time.perf_counter()
+            self.__metrics.observe(sub_cmd, self.__long_opt(sub_cmd, opt), end - start, failed,
+                                   overhead=time.perf_counter() - end)
+
+    def execute_opt(self, sub_cmd, opt, value, records=None):
+        """
+        与 run、run_all 相同地运行一个参数（执行后端、合并、缓存与执行指标），并返回处理函数或 exec 的返回值。
+        传入 records 时（管道中的后续子命令）记录流无法传给其他进程，也无法合并或缓存，只在当前进程中执行并记录执行指标
+
+        :param sub_cmd: 子命令名
+        :param opt: 参数名，传入的可能是短参名也可能是长参名
+        :param value: 参数值
+        :param records: 管道中上一个子命令输出的记录，为空时不传
+        :return: 处理函数或 exec 的返回值
+        """
+        return self.__execute_opt(sub_cmd, opt, value, records)
+
+    def __execute_opt_unmeasured(self, sub_cmd, opt, value, records=None):
+        if records is not None:
+            return self.execute(sub_cmd, opt, value, records)
+        if self.__executor is not None:
+            func = partial(self.__executor.execute, sub_cmd, opt, value)
+        else:
+            func = partial(self.execute, sub_cmd, opt, value)
+        policy, arg = self.__coalesce_policy(sub_cmd, opt)
+        # 以长参名作为标识，使 -r 与 --restart 视为相同的调用
+        long_opt = arg.long_name if arg is not None else opt
+        if policy:
+            if self.__single_flight is None:
+                from util.cmd_flight import SingleFlight
+                self.__single_flight = SingleFlight()
+            func = partial(self.__single_flight.run, (sub_cmd, long_opt, value), policy, func)
+        if arg is None or not arg.cache_ttl:
+            return func()
+
+        from util.cmd_cache import capture_output, write_output
+        cache = self.result_cache()
+        cached = cache.get(sub_cmd, long_opt, value)
+        if cached is not None:
+            result, output = cached
+            write_output(output)
+            return result
+        if self.__concurrency:
+            return func()
+        result, output = capture_output(func)
+        cache.put(sub_cmd, long_opt, value, result, output, arg.cache_ttl)
+        return result
+
+    def run(self, sub_cmd, opt, value):
+        if not opt:
+            return False
+        self.__execute_opt(sub_cmd, opt, value)
+        return True
+
+    def __partition_opts(self, sub_cmd, opts):
+        """
+        将参数分为依次执行与可并发执行两组
+
+        :param sub_cmd: 子命令名
+        :param opts: (参数名, 参数值) 的列表
+        :return: (依次执行的参数, 可并发的参数)，元素均为 (在 opts 中的位置, 参数名, 参数值)
+        """
+        if not self.__ensure_subcmd(sub_cmd):
+            raise CommandNotFoundError("Can not found command: %s" % sub_cmd)
+        sequential = []
+        concurrent = []
+        for idx, (opt, value) in enumerate(opts):
+            arg = self.__opt_arg(sub_cmd, opt)
+            if arg is not None and arg.concurrent:
+                concurrent.append((idx, opt, value))
+            else:
+                sequential.append((idx, opt, value))
+        return sequential, concurrent
+
+    def run_all(self, sub_cmd, opts):
+        """
+        运行子命令中的多个参数。声明为可并发（CmdArg.concurrent）的参数各自在线程池中并发执行，
+        其他参数按照命令行中的顺序依次执行，且与可并发的参数同时进行
+
+        :param sub_cmd: 子命令名
+        :param opts: (参数名, 参数值) 的列表
+        :return: 每个参数的执行结果 OptResult 的列表，顺序与 opts 一致
+        """
+        sequential, concurrent = self.__partition_opts(sub_cmd, opts)
+        results = [None] * len(opts)
+
+        def run_sequential():
+            for i, o, v in sequential:
+                results[i] = OptResult.call(o, v, self.__execute_opt, sub_cmd, o, v)
+
+        def run_concurrent(i, o, v):
+            results[i] = OptResult.call(o, v, self.__execute_opt, sub_cmd, o, v)
+
+        if len(concurrent) == 0 or len(opts) == 1:
+            run_sequential()
+            for i, o, v in concurrent:
+                run_concurrent(i, o, v)
+            return results
+        with self.concurrently(), ThreadPoolExecutor(max_workers=self.__max_workers) as executor:
+            futures = [executor.submit(run_concurrent, i, o, v) for i, o, v in concurrent]
+            if sequential:
+                futures.append(executor.submit(run_sequential))
+            for future in futures:
+                future.result()
+        return results
+
+    async def run_async(self, sub_cmd, opt, value):
+        """
+        run 的异步版本
+
+        :param sub_cmd: 子命令名
+        :param opt: 参数名，传入的可能是短参名也可能是长参名
+        :param value: 参数值
+        """
+        if not opt:
+            return False
+        await self.__execute_opt_async(sub_cmd, opt, value)
+        return True
+
+    async def run_all_async(self, sub_cmd, opts):
+        """
+        run_all 的异步版本，可并发的参数与依次执行的参数在事件循环中同时进行
+
+        :param sub_cmd: 子命令名
+        :param opts: (参数名, 参数值) 的列表
+        :return: 每个参数的执行结果 OptResult 的列表，顺序与 opts 一致
+        """
+        import asyncio
+
+        sequential, concurrent = self.__partition_opts(sub_cmd, opts)
+        results = [None] * len(opts)
+
+        async def run_one(i, o, v):
+            try:
+                results[i] = OptResult(o, v, result=await self.__execute_opt_async(sub_cmd, o, v))
+            except Exception as e:
+                traceback.print_exc(file=sys.stderr)
+                results[i] = OptResult(o, v, error=e)
+
+        async def run_sequential():
+            for i, o, v in sequential:
+                await run_one(i, o, v)
+
+        if len(concurrent) == 0 or len(opts) == 1:
+            await run_sequential()
+            for i, o, v in concurrent:
+                await run_one(i, o, v)
+            return results
+        with self.concurrently():
+            await asyncio.gather(run_sequential(), *[run_one(i, o, v) for i, o, v in concurrent])
+        return results
+
+
+def accepts_records(func):
+    """
+    处理函数或 exec 是否接收管道中的记录，即是否有名为 records 的参数或 **kwargs
+
+    :param func: 处理函数，或绑定了部分参数的 exec
+    :return: 接收时返回 True
+    """
+    import inspect
+
+    try:
+        parameters = inspect.signature(func).parameters.values()
+    except (TypeError, ValueError):
         return False
+    return any(p.name == 'records' or p.kind == p.VAR_KEYWORD for p in parameters)
+
+
+def is_records(result):
+    """
+    返回值是否为记录流：生成器、迭代器或列表等可迭代对象，字符串、字节串和字典除外
+
+    :param result: 处理函数或 exec 的返回值
+    :return: 是记录流时返回 True
+    """
+    return isinstance(result, Iterable) and not isinstance(result, (str, bytes, bytearray, dict))
+
+
+def print_records(records):
+    """
+    逐条输出记录流，生成器在此时才真正执行
+
+    :param records: 记录流
+    """
+    for record in records:
+        print(record)
+
+
+def _print_results(results):
+    """
+    输出返回记录流的参数的记录，与只有一个子命令的管道一致。输出中抛出的异常记录到对应的执行结果中
+
+    :param results: 执行结果 OptResult 的列表
+    :return: results
+    """
+    for result in results:
+        if result.error is None and is_records(result.result):
+            records, result.result = result.result, None
+            try:
+                print_records(records)
+            except Exception as e:
+                traceback.print_exc(file=sys.stderr)
+                result.error = e
+    return results
+
+
+def split_pipeline(argv):
+    """
+    以 :: 拆分管道中的各个子命令
+
+    :param argv: 命令行参数，格式与 sys.argv 相同，如 ['cmd.py', 'a', '-x', '::', 'b', '-y']
+    :return: 各个子命令的命令行参数，格式均与 sys.argv 相同；不含 :: 时只有一个元素
+    """
+    stages = [[argv[0]]]
+    for token in argv[1:]:
+        if token == PIPE_SEPARATOR:
+            stages.append([argv[0]])
+        else:
+            stages[-1].append(token)
+    return stages
+
+
+def parse_cmd(argv, helper: CmdHelper):
+    """
+    解析命令行参数。需要打印帮助或参数错误时，打印帮助并返回退出码
+
+    :param argv: 命令行参数，格式与 sys.argv 相同
+    :param helper: 已调用过 assemble 的 CmdHelper
+    :return: (退出码, 子命令名, (参数名, 参数值) 的列表)，退出码不为空时无需执行子命令
+    """
+    if len(argv) < 2 or not argv[1] or argv[1] == '-h':
+        helper.usage()
+        return 0, None, None
+
+    sub_cmd = helper.resolve_subcmd(argv[1])
+    if sub_cmd is None:
+        suggestions = helper.suggest_subcmds(argv[1])
+        if not suggestions:
+            helper.usage()
+            return 2, argv[1], None
+        print('Unknown command: %s' % argv[1], file=sys.stderr)
+        print('Did you mean: %s' % ', '.join(suggestions), file=sys.stderr)
+        return 2, argv[1], None
+    parser = helper.parser(sub_cmd)
+    try:
+        with helper.profiler().phase('parse', sub_cmd):
+            if parser is not None:
+                opts, args = parser.parse(argv[2:])
+            else:
+                opts, args = getopt.getopt(argv[2:], helper.short_opts(sub_cmd), helper.long_opts(sub_cmd))
+    except (InvalidParameterError, InsufficientParametersError, getopt.GetoptError) as e:
+        print('%s: %s' % (sub_cmd, e), file=sys.stderr)
+        helper.usage(sub_cmd)
+        return 2, sub_cmd, None
+
+    for opt, val in opts:
+        if opt in ('-h', '--help'):
+            helper.usage(sub_cmd)
+            return 0, sub_cmd, opts
+    return None, sub_cmd, opts
+
+
+def _parse_error(code, exit_on_error):
+    """
+    parse_cmd 返回的退出码，参数错误且 exit_on_error 为 True 时以退出码 2 退出进程
+    """
+    if code == 2 and exit_on_error:
+        sys.exit(2)
+    return code
+
+
+def dispatch_cmd(argv, helper: CmdHelper, exit_on_error=False):
+    """
+    解析命令行参数，并使用已组装的 helper 执行对应的子命令。与 run_cmd 不同，此函数不会组装 helper，默认也不会退出进程
+
+    :param argv: 命令行参数，格式与 sys.argv 相同
+    :param helper: 已调用过 assemble 的 CmdHelper
+    :param exit_on_error: 参数错误时是否以退出码 2 退出进程，子命令返回的退出码不受影响
+    :return: 退出码，参数错误为 2，否则为各参数执行结果汇总后的退出码。
+             返回记录流（如生成器）的参数与只有一个子命令的管道一致，记录逐条输出到标准输出
+    """
+    if PIPE_SEPARATOR in argv:
+        return dispatch_pipeline(split_pipeline(argv), helper, exit_on_error)
+    code, sub_cmd, opts = parse_cmd(argv, helper)
+    if code is not None:
+        return _parse_error(code, exit_on_error)
+    return results_exit_code(_print_results(helper.run_all(sub_cmd, opts)))
+
+
+def dispatch_pipeline(stages, helper: DefaultCmdHelper, exit_on_error=False):
+    """
+    在当前进程中执行管道，如 cmd.py a -x :: b -y。每个子命令只能有一个参数，
+    上一个子命令返回的记录流（如生成器）以关键字参数 records 直接传给下一个子命令，记录按需逐条产生，无需序列化；
+    最后一个子命令返回记录流时，逐条输出到标准输出
+
+    :param stages: 各个子命令的命令行参数，格式均与 sys.argv 相同
+    :param helper: 已调用过 assemble 的 DefaultCmdHelper
+    :param exit_on_error: 参数错误时是否以退出码 2 退出进程
+    :return: 退出码，参数错误（包括第一个之后的子命令不接收记录）为 2，抛出异常为 1，否则为第一个非 0 的返回值
+    """
+    calls = []
+    for stage in stages:
+        code, sub_cmd, opts = parse_cmd(stage, helper)
+        if code is not None:
+            return _parse_error(code, exit_on_error)
+        if len(opts) != 1:
+            print('Each pipeline stage takes exactly one option: %s' % ' '.join(stage[1:]), file=sys.stderr)
+            return _parse_error(2, exit_on_error)
+        if calls and not accepts_records(helper.resolve(sub_cmd, opts[0][0])):
+            print('%s: %s does not accept records from the previous stage' % (sub_cmd, opts[0][0]), file=sys.stderr)
+            helper.usage(sub_cmd)
+            return _parse_error(2, exit_on_error)
+        calls.append((sub_cmd, opts[0][0], opts[0][1]))
+
+    results = []
+    records = None
+    try:
+        for sub_cmd, opt, value in calls:
+            result = helper.execute_opt(sub_cmd, opt, value, records)
+            results.append(OptResult(opt, value, result=None if is_records(result) else result))
+            records = result if is_records(result) else None
+        if records is not None:
+            print_records(records)
+    except Exception as e:
+        traceback.print_exc(file=sys.stderr)
+        results.append(OptResult(None, None, error=e))
+    return results_exit_code(results)
+
+
+def run_pipeline(stages, loader: CmdLoader, helper: DefaultCmdHelper = None):
+    """
+    加载并组装子命令，然后在当前进程中执行管道，参考 dispatch_pipeline
+
+    :param stages: 各个子命令的参数（不含 cmd.py 本身），如 [['a', '-x'], ['b', '-y']]
+    :param loader: 子命令加载器
+    :param helper: 用户生成，为空时使用 DefaultCmdHelper
+    :return: 退出码
+    """
+    if helper is None:
+        helper = DefaultCmdHelper()
+    helper.set_cmd_loader(loader)
+    helper.assemble()
+    return dispatch_pipeline([[BATCH_PROG] + list(stage) for stage in stages], helper)
+
+
+async def dispatch_cmd_async(argv, helper: DefaultCmdHelper):
+    """
+    dispatch_cmd 的异步版本
+
+    :param argv: 命令行参数，格式与 sys.argv 相同
+    :param helper: 已调用过 assemble 的 DefaultCmdHelper
+    :return: 退出码，参数错误为 2，否则为各参数执行结果汇总后的退出码
+    """
+    code, sub_cmd, opts = parse_cmd(argv, helper)
+    if code is not None:
+        return code
+    return results_exit_code(_print_results(await helper.run_all_async(sub_cmd, opts)))
 
 
 def run_cmd(argv, loader: CmdLoader, helper: CmdHelper = None):
@@ -151,27 +899,100 @@ def run_cmd(argv, loader: CmdLoader, helper: CmdHelper = None):
     :param argv: 命令行参数 sys.argv
     :param loader: 子命令加载器，提供两种默认实现ModuleFileCmdLoader, SimpleCmdLoader，可按需传入
     :param helper: 用户生成
+    :return: 退出码，即各参数执行结果汇总后的退出码；参数错误时直接以退出码 2 退出进程
     """
     if helper is None:
         helper = DefaultCmdHelper()
     helper.set_cmd_loader(loader)
     helper.assemble()
+    return dispatch_cmd(argv, helper, exit_on_error=True)
 
-    if len(argv) < 2 or not argv[1] or argv[1] == '-h':
-        helper.usage()
-        return
 
-    sub_cmd = argv[1]
-    try:
-        opts, args = getopt.getopt(argv[2:], helper.short_opts(sub_cmd), helper.long_opts(sub_cmd))
-    except getopt.GetoptError:
-        helper.usage()
-        sys.exit(2)
+def run_batch(lines, loader: CmdLoader, helper: CmdHelper = None, workers=1):
+    """
+    批量执行命令。每一行按照 shell 的规则拆分为一次调用的参数（不含 cmd.py 本身），空行和以 # 开头的行被忽略。
+    所有行共用一次加载和组装的 helper，一行执行失败不影响其他行
 
-    for opt, val in opts:
-        if opt == "-h":
-            helper.usage(sub_cmd)
-            return
-        if helper.run(sub_cmd, opt, val):
-            return
-        helper.usage(sub_cmd)
+    :param lines: 命令行的可迭代对象，如文件对象
+    :param loader: 子命令加载器
+    :param helper: 用户生成，为空时使用 DefaultCmdHelper
+    :param workers: 并发执行的线程数，大于 1 时各行并发执行，输出可能交错
+    :return: (命令行, 退出码) 的列表，顺序与输入一致。执行中抛出异常的行退出码为 1
+    """
+    if helper is None:
+        helper = DefaultCmdHelper()
+    helper.set_cmd_loader(loader)
+    helper.assemble()
+
+    cmd_lines = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            cmd_lines.append(line)
+
+    def run_line(cmd_line):
+        try:
+            argv = [BATCH_PROG] + shlex.split(cmd_line)
+        except ValueError as e:
+            print('Invalid line: %s (%s)' % (cmd_line, e), file=sys.stderr)
+            return 2
+        try:
+            return dispatch_cmd(argv, helper)
+        except Exception:
+            traceback.print_exc()
+            return 1
+
+    if workers > 1:
+        with helper.concurrently(), ThreadPoolExecutor(max_workers=workers) as executor:
+            codes = list(executor.map(run_line, cmd_lines))
+    else:
+        codes = [run_line(cmd_line) for cmd_line in cmd_lines]
+    return list(zip(cmd_lines, codes))
+
+
+async def run_cmd_async(argv, loader: CmdLoader, helper: DefaultCmdHelper = None):
+    """
+    run_cmd 的异步版本，继承 command.AsyncCmd 的子命令直接在事件循环中运行，普通子命令在线程池中运行。与 run_cmd 不同，参数错误时不会退出进程
+
+    :param argv: 命令行参数 sys.argv
+    :param loader: 子命令加载器
+    :param helper: 用户生成，为空时使用 DefaultCmdHelper
+    :return: 退出码
+    """
+    if helper is None:
+        helper = DefaultCmdHelper()
+    helper.set_cmd_loader(loader)
+    helper.assemble()
+    return await dispatch_cmd_async(argv, helper)
+
+
+async def run_many_async(argvs, loader: CmdLoader, helper: DefaultCmdHelper = None, limit=DEFAULT_ASYNC_LIMIT):
+    """
+    在事件循环中并发执行多次调用，同时执行的调用数不超过 limit。所有调用共用一次加载和组装的 helper，一次调用失败不影响其他调用
+
+    :param argvs: 命令行参数的列表，每个元素的格式与 sys.argv 相同
+    :param loader: 子命令加载器
+    :param helper: 用户生成，为空时使用 DefaultCmdHelper
+    :param limit: 最大并发数
+    :return: 退出码的列表，顺序与 argvs 一致。执行中抛出异常的调用退出码为 1
+    """
+    import asyncio
+
+    if helper is None:
+        helper = DefaultCmdHelper()
+    helper.set_cmd_loader(loader)
+    helper.assemble()
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run_one(argv):
+        async with semaphore:
+            try:
+                return await dispatch_cmd_async(argv, helper)
+            except Exception:
+                traceback.print_exc()
+                return 1
+
+    if limit > 1 and len(argvs) > 1:
+        with helper.concurrently():
+            return list(await asyncio.gather(*[run_one(argv) for argv in argvs]))
+    return list(await asyncio.gather(*[run_one(argv) for argv in argvs]))
@@ -1,9 +1,12 @@
 # -*- coding: UTF-8 -*-
 import importlib
 import os
+import sys
+from collections import OrderedDict
 
 from command import Cmd
 from util import CmdLoader
+from util.cmd_manifest import CmdManifest
 
 
 def py_file_to_class_name(py_file):
@@ -34,6 +37,44 @@ def py_file_to_class_name(py_file):
     return ''.join(class_name)
 
 
+class DirIndex(object):
+    """
+    目录索引，缓存目录中的文件名与子目录名，只有目录的修改时间变化时才重新扫描。
+    扫描使用 os.scandir，通过目录项的类型区分文件与目录，无需对每个目录项额外调用 stat
+    """
+
+    def __init__(self):
+        self.__dirs = {}    # key为目录路径，value为 (修改时间, 文件名列表, 子目录名列表)
+
+    def scan(self, dir_path):
+        """
+        获取目录中的文件名与子目录名，均按名称排序。以"."开头的目录以及 __pycache__ 被忽略
+
+        :param dir_path: 目录路径
+        :return: (文件名列表, 子目录名列表)
+        """
+        mtime = os.stat(dir_path).st_mtime_ns
+        cached = self.__dirs.get(dir_path)
+        if cached and cached[0] == mtime:
+            return cached[1], cached[2]
+        files = []
+        sub_dirs = []
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    files.append(entry.name)
+                elif entry.is_dir() and not entry.name.startswith('.') and entry.name != '__pycache__':
+                    sub_dirs.append(entry.name)
+        files.sort()
+        sub_dirs.sort()
+        self.__dirs[dir_path] = (mtime, files, sub_dirs)
+        return files, sub_dirs
+
+
+# 进程内共享的目录索引，常驻进程中多次 load 时未修改的目录无需重新扫描
+dir_index = DirIndex()
+
+
 class ModuleFileCmdLoader(CmdLoader):
     """
     基于python模块文件动态加载的CmdLoader实现。
@@ -42,53 +83,215 @@ class ModuleFileCmdLoader(CmdLoader):
     """
 
     def __init__(self):
-        self.__cmd_list = []
+        self.__cmd_list = []    # 全部实例，调用 cmd_instances 时生成
         self.__cmd_dir = ''
         self.__module_name = 'command'
+        self.__extra_roots = []     # 额外的加载目录，元素为 (目录绝对路径, 模块名)
+        self.__recursive = False
         self.__file_suffix = '_cmd.py'
+        self.__lazy = False
+        self.__module_files = OrderedDict()     # 扫描到的子命令模块，key为模块的完整名称，value为py文件的绝对路径
+        self.__cmd_files = OrderedDict()    # 子命令索引，key为子命令名，value为模块的完整名称
+        self.__classes = {}     # 已加载的实现类，key为模块的完整名称，value为类
+        self.__module_specs = {}    # 已知的子命令名与参数定义，key为模块的完整名称，value为 (子命令名, 参数对象元组)
+        self.__file_instances = OrderedDict()   # 已创建的实例，key为模块的完整名称，value为实例
+        self.__name_instances = {}  # 已创建的实例，key为子命令名，value为实例
+        self.__all_instances = False    # 是否已创建全部实例
+        self.__module_stats = {}    # 已读取的py文件状态，key为模块的完整名称，value为 (修改时间, 大小)，用于 reload 时判断文件是否修改
+        self.__manifest = None  # 子命令清单缓存
+
+    def __cmd_roots(self):
+        """
+        全部加载目录
+
+        :return: (目录绝对路径, 模块名) 的列表
+        """
+        return [(self.__cmd_dir, self.__module_name)] + self.__extra_roots
+
+    def __scan_dir(self, cmd_dir, module_name, modules, is_root):
+        """
+        扫描目录中的py文件，递归加载时继续扫描子目录中的python包
+
+        :param cmd_dir: 目录绝对路径
+        :param module_name: 目录对应的模块名
+        :param modules: 扫描结果，key为模块的完整名称，value为py文件的绝对路径
+        :param is_root: 是否为加载目录本身，子目录中没有 __init__.py 时不是python包，将被忽略
+        """
+        files, sub_dirs = dir_index.scan(cmd_dir)
+        if not is_root and '__init__.py' not in files:
+            return
+        for f in files:
+            if f.endswith(self.__file_suffix):
+                modules[module_name + '.' + f[:len(f) - 3]] = os.path.join(cmd_dir, f)
+        if not self.__recursive:
+            return
+        for d in sub_dirs:
+            self.__scan_dir(os.path.join(cmd_dir, d), module_name + '.' + d, modules, False)
 
     def __find_cmd_py(self):
         """
-        扫描并返回目录中的py文件
+        扫描并返回全部加载目录中的py文件
 
-        :return: 目录中的py文件，非None
+        :return: key为模块的完整名称，value为py文件的绝对路径，非None
         """
-        files = []
-        for path in os.listdir(self.__cmd_dir):
-            full_path = os.path.join(self.__cmd_dir, path)
-            if path.endswith(self.__file_suffix) and os.path.isfile(full_path):
-                files.append(path)
-        return files
+        modules = OrderedDict()
+        for cmd_dir, module_name in self.__cmd_roots():
+            self.__scan_dir(cmd_dir, module_name, modules, True)
+        return modules
 
-    def __load_module(self, py_file):
+    def __load_module(self, cmd_module):
         """
         加载模块
 
-        :param py_file: py文件名
+        :param cmd_module: 模块的完整名称
         :return: 加载的模块对象
         """
-        if py_file.endswith('.py'):
-            py_file = py_file[:len(py_file) - 3]
-        return importlib.import_module('.' + py_file, self.__module_name)
+        with self.profiler().phase('import', cmd_module):
+            return importlib.import_module(cmd_module)
 
-    def __new_cmd_instance(self, py_file):
+    def __file_to_cmd_name(self, cmd_module):
         """
-        加载py文件中的类并创建实例。
+        将py文件名转换为子命令名，即去掉文件后缀。懒加载时以此作为子命令名的索引
 
+        :param cmd_module: 模块的完整名称
+        :return: 子命令名
+        """
+        py_file = os.path.basename(self.__module_files[cmd_module])
+        return py_file[:len(py_file) - len(self.__file_suffix)]
+
+    def __instance_of_file(self, cmd_module):
+        """
+        获取模块对应的实例，未创建时加载模块并创建
+
+        :param cmd_module: 模块的完整名称
         :return: 实例
         """
-        module = self.__load_module(py_file)
+        if cmd_module in self.__file_instances:
+            return self.__file_instances[cmd_module]
+        cmd_inst = self.__new_cmd_instance(cmd_module)
+        self.__file_instances[cmd_module] = cmd_inst
+        if cmd_inst:
+            self.__name_instances[cmd_inst.name()] = cmd_inst
+        return cmd_inst
+
+    def __spec_of_file(self, cmd_module):
+        """
+        获取模块对应的子命令名与参数定义。实现类在类属性中声明了子命令定义时只加载模块，不创建实例
+
+        :param cmd_module: 模块的完整名称
+        :return: (子命令名, 参数对象元组)，无法创建实例时返回空
+        """
+        if cmd_module in self.__module_specs:
+            return self.__module_specs[cmd_module]
+        clazz = self.__class_of_file(cmd_module)
+        schema = clazz.schema() if clazz and hasattr(clazz, 'schema') else None
+        if schema is not None:
+            spec = (schema.name, schema.arg_tuple())
+        else:
+            cmd_inst = self.__instance_of_file(cmd_module)
+            if not cmd_inst:
+                return None
+            spec = (cmd_inst.name(), cmd_inst.args())
+        self.__module_specs[cmd_module] = spec
+        return spec
+
+    def __index_file(self, cmd_module):
+        """
+        将模块加入子命令索引。
+        懒加载且未设置清单缓存时，以去掉后缀的文件名作为子命令名，不加载模块；
+        设置了清单缓存时，子命令名与参数定义从清单中读取，清单中不存在或已失效的文件才加载模块；
+        非懒加载时加载模块获取子命令名与参数定义
+
+        :param cmd_module: 模块的完整名称
+        """
+        if not self.__lazy:
+            spec = self.__spec_of_file(cmd_module)
+        elif not self.__manifest:
+            self.__cmd_files[self.__file_to_cmd_name(cmd_module)] = cmd_module
+            return
+        else:
+            stat = os.stat(self.__module_files[cmd_module])
+            self.__module_stats[cmd_module] = (stat.st_mtime_ns, stat.st_size)
+            spec = self.__manifest.lookup(cmd_module, stat)
+            if spec is None:
+                spec = self.__spec_of_file(cmd_module)
+                if spec:
+                    self.__manifest.update(cmd_module, stat, spec[0], spec[1])
+            else:
+                self.__module_specs[cmd_module] = spec
+        if spec:
+            self.__cmd_files[spec[0]] = cmd_module
+
+    def __class_of_file(self, cmd_module):
+        """
+        加载模块并获取其中的实现类，类名由py文件名按照首字母大写驼峰式转换
+
+        :param cmd_module: 模块的完整名称
+        :return: 实现类
+        """
+        if cmd_module in self.__classes:
+            return self.__classes[cmd_module]
+        if cmd_module not in self.__module_stats:
+            self.__module_stats[cmd_module] = self.__file_stat(cmd_module)
+        module = self.__load_module(cmd_module)
         if not module:
             return None
-        class_name = py_file_to_class_name(py_file)
+        class_name = py_file_to_class_name(os.path.basename(self.__module_files[cmd_module]))
         clazz = getattr(module, class_name)
+        self.__classes[cmd_module] = clazz
+        return clazz
+
+    def __file_stat(self, cmd_module):
+        """
+        获取模块py文件的修改时间和大小
+
+        :param cmd_module: 模块的完整名称
+        :return: (修改时间, 大小)，文件不存在时返回空
+        """
+        try:
+            stat = os.stat(self.__module_files[cmd_module])
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def __forget_file(self, cmd_module):
+        """
+        移除模块相关的实现类、定义、实例与索引
+
+        :param cmd_module: 模块的完整名称
+        :return: 该模块曾对应的子命令名
+        """
+        names = set(name for name, m in self.__cmd_files.items() if m == cmd_module)
+        spec = self.__module_specs.pop(cmd_module, None)
+        if spec:
+            names.add(spec[0])
+        cmd_inst = self.__file_instances.pop(cmd_module, None)
+        if cmd_inst:
+            names.add(cmd_inst.name())
+        for name in names:
+            if self.__cmd_files.get(name) == cmd_module:
+                del self.__cmd_files[name]
+            if self.__name_instances.get(name) is cmd_inst:
+                self.__name_instances.pop(name, None)
+        self.__classes.pop(cmd_module, None)
+        self.__module_stats.pop(cmd_module, None)
+        return names
+
+    def __new_cmd_instance(self, cmd_module):
+        """
+        加载模块中的类并创建实例。
+
+        :return: 实例
+        """
+        clazz = self.__class_of_file(cmd_module)
         if clazz:
-            return clazz()
+            with self.profiler().phase('instantiate', cmd_module):
+                return clazz()
         return None
 
     def set_cmd_dir(self, cmd_dir):
         """
-        设置加载的目录的绝对路径，扫描该路径下的所有py文件，注意，动态加载并不会加载此处目录的子目录
+        设置加载的目录的绝对路径，扫描该路径下的所有py文件，注意，未调用 set_recursive 时不会加载此处目录的子目录
 
         :param cmd_dir:  加载目录的绝对路径
         :return: 当前对象，允许链式调用
@@ -108,6 +311,28 @@ class ModuleFileCmdLoader(CmdLoader):
             self.__module_name = module_name
         return self
 
+    def add_cmd_root(self, cmd_dir, module_name):
+        """
+        添加额外的加载目录，如由其他团队维护的插件包。各加载目录中的子命令名不可重复，重复时后加载的覆盖先加载的
+
+        :param cmd_dir: 加载目录的绝对路径
+        :param module_name: 加载目录所对应的模块名，子模块时以"."分隔
+        :return: 当前对象，允许链式调用
+        """
+        if cmd_dir and isinstance(cmd_dir, str) and module_name and isinstance(module_name, str):
+            self.__extra_roots.append((cmd_dir, module_name))
+        return self
+
+    def set_recursive(self, recursive):
+        """
+        设置是否递归扫描加载目录中的子包，子目录中必须存在 __init__.py 才会被视为子包
+
+        :param recursive: 是否递归扫描 (bool)
+        :return: 当前对象，允许链式调用
+        """
+        self.__recursive = bool(recursive)
+        return self
+
     def set_file_suffix(self, file_suffix):
         """
         设置文件后缀，程序按照此设置的后缀过滤，排除非此后缀的文件。默认为 _cmd.py
@@ -119,30 +344,212 @@ class ModuleFileCmdLoader(CmdLoader):
             self.__file_suffix = file_suffix
         return self
 
+    def set_lazy(self, lazy):
+        """
+        设置是否懒加载。懒加载时 load 只扫描目录，将文件名去掉后缀作为子命令名建立索引，不加载任何模块；
+        子命令的模块在 cmd_instance 中按需加载，只有调用 cmd_instances 获取全部实例时才会加载所有模块。
+        注意，未设置清单缓存时懒加载要求子命令名与去掉后缀的文件名一致，不一致时将退化为加载全部模块查找
+
+        :param lazy: 是否懒加载 (bool)
+        :return: 当前对象，允许链式调用
+        """
+        self.__lazy = bool(lazy)
+        return self
+
+    def set_manifest_file(self, manifest_file):
+        """
+        设置子命令清单缓存文件的绝对路径，仅在懒加载模式下生效。
+        清单中记录每个子命令文件的修改时间、大小、子命令名和参数定义，文件未修改时组装帮助和解析参数均无需加载模块，
+        只有最终运行的子命令才会加载
+
+        :param manifest_file: 清单文件的绝对路径
+        :return: 当前对象，允许链式调用
+        """
+        if manifest_file and isinstance(manifest_file, str):
+            self.__manifest = CmdManifest(manifest_file)
+        return self
+
+    def is_lazy(self):
+        """
+        是否为懒加载模式
+
+        :return: 是否懒加载 (bool)
+        """
+        return self.__lazy
+
+    def cmd_dirs(self):
+        """
+        全部加载目录，包括 set_cmd_dir 与 add_cmd_root 设置的目录
+
+        :return: 目录绝对路径的列表
+        """
+        return [cmd_dir for cmd_dir, _ in self.__cmd_roots() if cmd_dir]
+
+    def file_suffix(self):
+        """
+        子命令文件的后缀
+
+        :return: 后缀，默认为 _cmd.py
+        """
+        return self.__file_suffix
+
+    def cmd_modules(self):
+        """
+        获取全部子命令的实现类所在的模块与类名，用于生成静态注册表（参考 util.cmd_registry），会加载全部模块
+
+        :return: (子命令名, 模块的完整名称, 类名, 参数对象元组) 的列表
+        """
+        entries = []
+        for cmd_module, py_file in self.__module_files.items():
+            spec = self.__spec_of_file(cmd_module)
+            if spec:
+                entries.append((spec[0], cmd_module, py_file_to_class_name(os.path.basename(py_file)), spec[1]))
+        return entries
+
     def load(self):
         """
         加载命令实现类。若设置的路径未能扫描到实现类文件，该方法会提前结束但是不会抛出异常。
-        但是若扫描到文件却未能成功加载实现类，该方法中断并抛出异常
+        但是若扫描到文件却未能成功加载实现类，该方法中断并抛出异常。懒加载模式下只建立子命令名的索引。
+        实现类在类属性中声明了子命令定义时，只加载模块而不创建实例，实例在运行子命令时才创建
 
         :return: 当前对象，允许链式调用
         """
-        files = self.__find_cmd_py()
-        if not files or len(files) == 0:
-            return
-        for f in files:
-            cmd_inst = self.__new_cmd_instance(f)
-            if cmd_inst:
-                self.__cmd_list.append(cmd_inst)
+        self.__cmd_list = []
+        self.__cmd_files = OrderedDict()
+        self.__classes = {}
+        self.__module_specs = {}
+        self.__file_instances = OrderedDict()
+        self.__name_instances = {}
+        self.__all_instances = False
+        self.__module_stats = {}
+        use_manifest = self.__lazy and self.__manifest
+        if use_manifest:
+            with self.profiler().phase('manifest', 'load'):
+                self.__manifest.load()
+        with self.profiler().phase('scan'):
+            self.__module_files = self.__find_cmd_py()
+        for cmd_module in self.__module_files.keys():
+            self.__index_file(cmd_module)
+        if use_manifest:
+            with self.profiler().phase('manifest', 'save'):
+                self.__manifest.retain(self.__module_files.keys())
+                self.__manifest.save()
         return self
 
+    def reload(self):
+        """
+        增量重新加载。重新扫描加载目录，只处理新增、修改（修改时间或大小变化）和删除的py文件：
+        已加载过的修改模块通过 importlib.reload 重新加载，未修改的子命令保持不变。
+        尚未读取过的文件（懒加载时未使用的子命令）无需处理，使用时会读取最新的内容
+
+        :return: (新增的子命令名, 修改的子命令名, 删除的子命令名)，均为集合
+        """
+        use_manifest = self.__lazy and self.__manifest
+        with self.profiler().phase('scan'):
+            module_files = self.__find_cmd_py()
+        old_files = self.__module_files
+        added_modules = [m for m in module_files.keys() if m not in old_files]
+        removed_modules = [m for m in old_files.keys() if m not in module_files]
+        changed_modules = [m for m in module_files.keys()
+                           if m in old_files and m in self.__module_stats
+                           and self.__module_stats[m] != self.__file_stat(m)]
+
+        added, changed, removed = set(), set(), set()
+        for cmd_module in removed_modules:
+            removed |= self.__forget_file(cmd_module)
+        for cmd_module in changed_modules:
+            changed |= self.__forget_file(cmd_module)
+        self.__module_files = module_files
+        for cmd_module in changed_modules:
+            if cmd_module in sys.modules:
+                with self.profiler().phase('import', cmd_module):
+                    importlib.reload(sys.modules[cmd_module])
+            self.__index_file(cmd_module)
+            changed |= set(name for name, m in self.__cmd_files.items() if m == cmd_module)
+        for cmd_module in added_modules:
+            self.__index_file(cmd_module)
+            added |= set(name for name, m in self.__cmd_files.items() if m == cmd_module)
+
+        if added_modules or changed_modules or removed_modules:
+            self.__all_instances = False
+            self.__cmd_list = []
+            if use_manifest:
+                self.__manifest.retain(self.__module_files.keys())
+                self.__manifest.save()
+        return added, changed, removed
+
     def cmd_instances(self):
         """
-        获取所有加载的Cmd实例
+        获取所有加载的Cmd实例，尚未创建的实例在此时创建，懒加载模式下会加载全部尚未加载的模块
 
         :return: 实例列表，加载失败为空列表
         """
+        if not self.__all_instances:
+            self.__cmd_list = []
+            for cmd_module in self.__module_files.keys():
+                cmd_inst = self.__instance_of_file(cmd_module)
+                if cmd_inst:
+                    self.__cmd_list.append(cmd_inst)
+            self.__all_instances = True
         return self.__cmd_list
 
+    def cmd_names(self):
+        """
+        获取所有子命令名。懒加载且未设置清单缓存时返回以文件名建立的索引，不会加载模块
+
+        :return: 子命令名列表
+        """
+        return list(self.__cmd_files.keys())
+
+    def cmd_instance(self, name):
+        """
+        通过子命令名获取Cmd实例，只创建该子命令的实例，懒加载模式下只加载该子命令对应的模块
+
+        :param name: 子命令名
+        :return: Cmd实例，子命令不存在时返回空
+        """
+        if name in self.__name_instances:
+            return self.__name_instances[name]
+        cmd_module = self.__cmd_files.get(name)
+        if cmd_module:
+            cmd_inst = self.__instance_of_file(cmd_module)
+            if cmd_inst and cmd_inst.name() == name:
+                return cmd_inst
+        if not self.__lazy or self.__manifest:
+            return None
+        # 索引中是文件名，子命令名与文件名不一致时加载全部模块后查找；使用清单缓存时索引中已是子命令名，无需查找
+        self.cmd_instances()
+        return self.__name_instances.get(name)
+
+    def cmd_args(self, name):
+        """
+        通过子命令名获取子命令的参数定义，清单缓存或类属性中存在定义时无需创建实例
+
+        :param name: 子命令名
+        :return: 参数对象CmdArg的元组，子命令不存在时返回空
+        """
+        cmd_module = self.__cmd_files.get(name)
+        if cmd_module:
+            spec = self.__spec_of_file(cmd_module)
+            if spec and spec[0] == name:
+                return spec[1]
+        if not self.__lazy or self.__manifest:
+            return None
+        return super().cmd_args(name)
+
+    def cmd_specs(self):
+        """
+        获取所有子命令的子命令名与参数定义，清单缓存或类属性中存在定义时无需创建实例
+
+        :return: (子命令名, 参数对象元组) 的列表
+        """
+        specs = []
+        for cmd_module in self.__module_files.keys():
+            spec = self.__spec_of_file(cmd_module)
+            if spec:
+                specs.append(spec)
+        return specs
+
 
 class SimpleCmdLoader(CmdLoader):
     """
@@ -177,3 +584,94 @@ class SimpleCmdLoader(CmdLoader):
         :return: 实例列表，若未调用add则返回空列表
         """
         return self.__cmd_list
+
+
+class StaticCmdLoader(CmdLoader):
+    """
+    基于静态注册表的CmdLoader实现。注册表是由 util.cmd_registry 生成的模块，记录了子命令名、实现类所在的模块与类名以及参数定义，
+    加载时只导入注册表，无需扫描目录和转换类名，组装帮助和解析参数都无需加载子命令模块，只有运行的子命令才会加载
+    """
+
+    def __init__(self, registry_module='command._registry'):
+        """
+        创建加载器
+
+        :param registry_module: 注册表模块的完整名称
+        """
+        self.__registry_module = registry_module
+        self.__entries = OrderedDict()  # 注册表中的子命令，key为子命令名，value为 (模块的完整名称, 类名, 参数对象元组)
+        self.__instances = OrderedDict()    # 已创建的实例，key为子命令名，value为实例
+
+    def load(self):
+        """
+        导入注册表
+
+        :return: 当前对象，允许链式调用
+        """
+        with self.profiler().phase('import', self.__registry_module):
+            registry = importlib.import_module(self.__registry_module)
+        self.__entries = OrderedDict((name, (cmd_module, class_name, args))
+                                     for name, cmd_module, class_name, args in registry.COMMANDS)
+        self.__instances = OrderedDict()
+        return self
+
+    def is_lazy(self):
+        """
+        静态注册表中已有参数定义，组装时无需加载子命令模块
+
+        :return: True
+        """
+        return True
+
+    def cmd_instance(self, name):
+        """
+        通过子命令名获取实例，首次获取时加载该子命令的模块并创建实例
+
+        :param name: 子命令名
+        :return: 实例，子命令不存在时返回空
+        """
+        if name in self.__instances:
+            return self.__instances[name]
+        entry = self.__entries.get(name)
+        if entry is None:
+            return None
+        with self.profiler().phase('import', entry[0]):
+            module = importlib.import_module(entry[0])
+        with self.profiler().phase('instantiate', entry[0]):
+            cmd_inst = getattr(module, entry[1])()
+        self.__instances[name] = cmd_inst
+        return cmd_inst
+
+    def cmd_instances(self):
+        """
+        获取全部子命令的实例，会加载全部子命令模块
+
+        :return: 实例列表
+        """
+        return [cmd for cmd in (self.cmd_instance(name) for name in self.__entries.keys()) if cmd]
+
+    def cmd_names(self):
+        """
+        获取所有子命令名，无需加载子命令模块
+
+        :return: 子命令名列表
+        """
+        return list(self.__entries.keys())
+
+    def cmd_args(self, name):
+        """
+        通过子命令名获取参数定义，无需加载子命令模块
+
+        :param name: 子命令名
+        :return: 参数对象CmdArg的元组，子命令不存在时返回空
+        """
+        entry = self.__entries.get(name)
+        return entry[2] if entry else None
+
+    def cmd_specs(self):
+        """
+        获取所有子命令的子命令名与参数定义，无需加载子命令模块
+
+        :return: (子命令名, 参数对象元组) 的列表
+        """
+        return [(name, entry[2]) for name, entry in self.__entries.items()]
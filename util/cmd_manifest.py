@@ -0,0 +1,122 @@
+# -*- coding: UTF-8 -*-
+import json
+import os
+
+from command import CmdArg
+from util.cmd_parser import type_ref
+
+MANIFEST_VERSION = 6
+
+
+class CmdManifest(object):
+    """
+    子命令清单缓存，持久化到磁盘的json文件。
+    以子命令模块的完整名称为key，记录子命令名与参数定义，并以文件的修改时间和大小判断是否失效，
+    使得未修改的子命令在组装帮助和解析参数时无需加载模块
+    """
+
+    def __init__(self, manifest_file):
+        """
+        创建清单缓存
+
+        :param manifest_file: 清单文件的绝对路径
+        """
+        self.__manifest_file = manifest_file
+        self.__entries = {}  # 清单条目，key为模块的完整名称，value为条目
+        self.__dirty = False
+
+    @staticmethod
+    def __arg_to_list(arg: CmdArg):
+        # handler 只在子命令实例中使用，无需缓存；参数值类型以 module:qualname 的引用字符串缓存
+        return [arg.short_name, arg.long_name, arg.need_value, arg.description,
+                {'concurrent': arg.concurrent, 'coalesce': arg.coalesce, 'cache_ttl': arg.cache_ttl,
+                 'value_type': type_ref(arg.value_type), 'repeatable': arg.repeatable}]
+
+    @staticmethod
+    def __list_to_arg(values):
+        return CmdArg(*values[:4], **values[4])
+
+    def load(self):
+        """
+        读取清单文件，文件不存在、格式错误或版本不一致时视为空清单
+
+        :return: 当前对象，允许链式调用
+        """
+        self.__entries = {}
+        self.__dirty = False
+        try:
+            with open(self.__manifest_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return self
+        if isinstance(data, dict) and data.get('version') == MANIFEST_VERSION:
+            self.__entries = data.get('entries', {})
+        return self
+
+    def lookup(self, cmd_module, stat):
+        """
+        查找模块对应的有效条目
+
+        :param cmd_module: 模块的完整名称
+        :param stat: 模块py文件的 os.stat 结果
+        :return: (子命令名, 参数对象元组)，条目不存在或已失效时返回空
+        """
+        entry = self.__entries.get(cmd_module)
+        if not entry or entry['mtime'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+            return None
+        return entry['name'], tuple(self.__list_to_arg(a) for a in entry['args'])
+
+    def update(self, cmd_module, stat, name, args):
+        """
+        更新模块对应的条目
+
+        :param cmd_module: 模块的完整名称
+        :param stat: 模块py文件的 os.stat 结果
+        :param name: 子命令名
+        :param args: 参数对象元组
+        """
+        try:
+            arg_lists = [self.__arg_to_list(a) for a in args]
+        except ValueError:
+            # 参数值类型无法通过名称引用时不缓存，该模块每次都会被加载
+            self.__entries.pop(cmd_module, None)
+            self.__dirty = True
+            return
+        self.__entries[cmd_module] = {
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'name': name,
+            'args': arg_lists,
+        }
+        self.__dirty = True
+
+    def retain(self, cmd_modules):
+        """
+        移除不在指定文件中的条目，即已删除的子命令
+
+        :param cmd_modules: 当前存在的模块的完整名称
+        """
+        keep = set(cmd_modules)
+        for cmd_module in list(self.__entries.keys()):
+            if cmd_module not in keep:
+                del self.__entries[cmd_module]
+                self.__dirty = True
+
+    def save(self):
+        """
+        清单有修改时写入文件。先写入临时文件再替换，避免并发运行时读取到不完整的文件；
+        写入失败（如目录无写权限）时忽略，不影响命令的运行
+        """
+        if not self.__dirty:
+            return
+        tmp_file = '%s.%d.tmp' % (self.__manifest_file, os.getpid())
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump({'version': MANIFEST_VERSION, 'entries': self.__entries}, f)
+            os.replace(tmp_file, self.__manifest_file)
+            self.__dirty = False
+        except OSError:
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
@@ -0,0 +1,259 @@
+# -*- coding: UTF-8 -*-
+import atexit
+import bisect
+import fcntl
+import json
+import os
+import sys
+import threading
+import time
+
+METRICS_FILE_ENV = 'CMD_METRICS_FILE'
+METRICS_FLUSH_INTERVAL_ENV = 'CMD_METRICS_FLUSH_INTERVAL'
+METRICS_STATE_VERSION = 1
+PROM_SUFFIX = '.prom'
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+
+# 每个序列的计数列表中的位置
+COUNT = 0
+FAILURES = 1
+SUM = 2
+BUCKETS = 3
+
+
+def is_failure(result):
+    """
+    参数的返回值是否表示失败，与 OptResult.exit_code 一致：返回值为非 0 的 int（bool 除外）时视为失败
+
+    :param result: 处理函数或 exec 的返回值
+    :return: 是否失败
+    """
+    return isinstance(result, int) and not isinstance(result, bool) and result != 0
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_le(bound):
+    return '%g' % bound
+
+
+class CmdMetrics(object):
+    """
+    子命令的执行指标，按 (子命令名, 长参名) 记录执行次数、失败次数以及耗时的直方图，并按子命令汇总。
+    每个序列在内存中只是一个计数列表 [次数, 失败次数, 耗时总和, 各区间的次数...]，记录一次只需一次二分查找和几次加法。
+    调用 flush 时在文件锁中与文件中已有的累计值合并后原子地替换文件，多个 cmd.py 进程可以写入同一个文件。
+    记录本身的耗时也会被统计（cmd_metrics_overhead_seconds_total），用于确认开启指标的代价
+    """
+
+    def __init__(self, metrics_file, buckets=DEFAULT_BUCKETS, flush_interval=None):
+        """
+        创建指标
+
+        :param metrics_file: 输出文件路径。以 .prom 结尾时输出为 Prometheus node-exporter 的 textfile 格式，
+                             累计值另存于同目录的 <metrics_file>.json（textfile collector 只读取 .prom 文件）；否则输出为 json
+        :param buckets: 耗时直方图各区间的上界（秒），升序
+        :param flush_interval: 自动写入文件的间隔秒数，用于守护进程等常驻进程，为空时只在调用 flush 时写入
+        """
+        self.__metrics_file = metrics_file
+        self.__state_file = metrics_file + '.json' if metrics_file.endswith(PROM_SUFFIX) else metrics_file
+        self.__buckets = tuple(buckets)
+        self.__flush_interval = flush_interval
+        self.__series = {}  # 尚未写入文件的计数，key为 (子命令名, 长参名)，value为计数列表
+        self.__overhead = 0.0   # 尚未写入文件的记录耗时（秒）
+        self.__observations = 0  # 尚未写入文件的记录次数
+        self.__flushed = time.monotonic()  # 上次写入文件的时间
+        self.__lock = threading.Lock()
+
+    def metrics_file(self):
+        """
+        获取输出文件路径
+
+        :return: 输出文件路径
+        """
+        return self.__metrics_file
+
+    is_failure = staticmethod(is_failure)
+
+    def observe(self, sub_cmd, opt, elapsed, failed=False, overhead=0.0):
+        """
+        记录一次参数的执行
+
+        :param sub_cmd: 子命令名
+        :param opt: 长参名
+        :param elapsed: 耗时秒数
+        :param failed: 是否失败
+        :param overhead: 调用方为记录指标额外花费的秒数（如计时、查找参数名），与本方法的耗时一起计入记录的开销
+        """
+        start = time.perf_counter() - overhead
+        idx = BUCKETS + bisect.bisect_left(self.__buckets, elapsed)
+        key = (sub_cmd, opt)
+        with self.__lock:
+            counts = self.__series.get(key)
+            if counts is None:
+                counts = [0, 0, 0.0] + [0] * (len(self.__buckets) + 1)
+                self.__series[key] = counts
+            counts[COUNT] += 1
+            counts[SUM] += elapsed
+            counts[idx] += 1
+            if failed:
+                counts[FAILURES] += 1
+            self.__observations += 1
+            self.__overhead += time.perf_counter() - start
+        if self.__flush_interval and time.monotonic() - self.__flushed >= self.__flush_interval:
+            self.flush()
+
+    def overhead(self):
+        """
+        尚未写入文件的记录的平均开销，包括调用方传入的 overhead
+
+        :return: 平均每次记录的耗时（微秒），没有记录时为 0
+        """
+        with self.__lock:
+            return self.__overhead / self.__observations * 1e6 if self.__observations else 0.0
+
+    def snapshot(self):
+        """
+        获取尚未写入文件的计数
+
+        :return: dict，key为 (子命令名, 长参名)，value为计数列表 [次数, 失败次数, 耗时总和, 各区间的次数...]，最后一个区间为 +Inf
+        """
+        with self.__lock:
+            return {key: list(counts) for key, counts in self.__series.items()}
+
+    def __empty_state(self):
+        return {'version': METRICS_STATE_VERSION, 'buckets': list(self.__buckets), 'series': [],
+                'overhead_seconds': 0.0, 'observations': 0}
+
+    def __read_state(self):
+        """
+        读取文件中的累计值，文件不存在、损坏或直方图区间不同时返回空的累计值
+        """
+        try:
+            with open(self.__state_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return self.__empty_state()
+        if not isinstance(state, dict) or state.get('version') != METRICS_STATE_VERSION \
+                or state.get('buckets') != list(self.__buckets):
+            return self.__empty_state()
+        return state
+
+    @staticmethod
+    def __replace(path, text):
+        tmp_file = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_file, path)
+
+    def flush(self):
+        """
+        将尚未写入的计数与文件中的累计值合并后写入文件，写入后清零内存中的计数。
+        合并在 <文件>.lock 的排他锁（fcntl.flock）中进行，文件先写入临时文件再替换，读取者不会读到不完整的文件
+        """
+        with self.__lock:
+            series, self.__series = self.__series, {}
+            overhead, self.__overhead = self.__overhead, 0.0
+            observations, self.__observations = self.__observations, 0
+            self.__flushed = time.monotonic()
+        if not series and not observations:
+            return
+
+        metrics_dir = os.path.dirname(self.__metrics_file)
+        if metrics_dir:
+            os.makedirs(metrics_dir, exist_ok=True)
+        lock_fd = os.open(self.__state_file + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            state = self.__read_state()
+            merged = {(s['command'], s['option']): s['counts'] for s in state['series']}
+            for key, counts in series.items():
+                total = merged.get(key)
+                merged[key] = counts if total is None else [a + b for a, b in zip(total, counts)]
+            state['series'] = [{'command': sub_cmd, 'option': opt, 'counts': counts}
+                               for (sub_cmd, opt), counts in sorted(merged.items())]
+            state['overhead_seconds'] += overhead
+            state['observations'] += observations
+            self.__replace(self.__state_file, json.dumps(state, sort_keys=True) + '\n')
+            if self.__state_file != self.__metrics_file:
+                self.__replace(self.__metrics_file, self.prometheus_text(state))
+        finally:
+            os.close(lock_fd)
+
+    def prometheus_text(self, state):
+        """
+        将累计值转换为 Prometheus 的文本格式
+
+        :param state: 文件中的累计值
+        :return: 文本
+        """
+        lines = []
+        per_cmd = {}
+        for s in state['series']:
+            runs, failures = per_cmd.get(s['command'], (0, 0))
+            per_cmd[s['command']] = (runs + s['counts'][COUNT], failures + s['counts'][FAILURES])
+
+        def header(name, metric_type, help_text):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+
+        header('cmd_subcommand_runs_total', 'counter', 'Options executed per sub-command.')
+        for sub_cmd, (runs, _) in sorted(per_cmd.items()):
+            lines.append('cmd_subcommand_runs_total{command="%s"} %d' % (_escape_label(sub_cmd), runs))
+        header('cmd_subcommand_failures_total', 'counter', 'Failed options per sub-command.')
+        for sub_cmd, (_, failures) in sorted(per_cmd.items()):
+            lines.append('cmd_subcommand_failures_total{command="%s"} %d' % (_escape_label(sub_cmd), failures))
+
+        header('cmd_option_runs_total', 'counter', 'Executions per option.')
+        failure_lines = []
+        duration_lines = []
+        for s in state['series']:
+            labels = 'command="%s",option="%s"' % (_escape_label(s['command']), _escape_label(s['option']))
+            counts = s['counts']
+            lines.append('cmd_option_runs_total{%s} %d' % (labels, counts[COUNT]))
+            failure_lines.append('cmd_option_failures_total{%s} %d' % (labels, counts[FAILURES]))
+            cumulative = 0
+            for bound, count in zip(list(self.__buckets) + [None], counts[BUCKETS:]):
+                cumulative += count
+                le = '+Inf' if bound is None else _format_le(bound)
+                duration_lines.append('cmd_option_duration_seconds_bucket{%s,le="%s"} %d'
+                                      % (labels, le, cumulative))
+            duration_lines.append('cmd_option_duration_seconds_sum{%s} %.9g' % (labels, counts[SUM]))
+            duration_lines.append('cmd_option_duration_seconds_count{%s} %d' % (labels, counts[COUNT]))
+        header('cmd_option_failures_total', 'counter', 'Failed executions per option.')
+        lines.extend(failure_lines)
+        header('cmd_option_duration_seconds', 'histogram', 'Option execution time in seconds.')
+        lines.extend(duration_lines)
+
+        header('cmd_metrics_overhead_seconds_total', 'counter', 'Time spent recording these metrics.')
+        lines.append('cmd_metrics_overhead_seconds_total %.9g' % state['overhead_seconds'])
+        header('cmd_metrics_observations_total', 'counter', 'Number of recorded executions.')
+        lines.append('cmd_metrics_observations_total %d' % state['observations'])
+        return '\n'.join(lines) + '\n'
+
+
+def metrics_from_env():
+    """
+    根据环境变量创建指标：CMD_METRICS_FILE 为输出文件路径，CMD_METRICS_FLUSH_INTERVAL 为自动写入的间隔秒数，
+    间隔不是正数时输出警告并忽略，即只在进程退出时写入。创建的指标在进程退出时写入文件
+
+    :return: CmdMetrics，未设置 CMD_METRICS_FILE 时返回空
+    """
+    metrics_file = os.environ.get(METRICS_FILE_ENV)
+    if not metrics_file:
+        return None
+    interval = os.environ.get(METRICS_FLUSH_INTERVAL_ENV)
+    flush_interval = None
+    if interval:
+        try:
+            flush_interval = float(interval)
+        except ValueError:
+            pass
+        if flush_interval is None or not flush_interval > 0:
+            print('Ignoring %s=%s: not a positive number of seconds' % (METRICS_FLUSH_INTERVAL_ENV, interval),
+                  file=sys.stderr)
+            flush_interval = None
+    metrics = CmdMetrics(metrics_file, flush_interval=flush_interval)
+    atexit.register(metrics.flush)
+    return metrics
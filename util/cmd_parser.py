@@ -0,0 +1,159 @@
+# -*- coding: UTF-8 -*-
+import importlib
+
+from command import CmdArg
+from util import InsufficientParametersError, InvalidParameterError
+
+HELP_OPTS = ('-h', '--help')
+
+
+def type_ref(value_type):
+    """
+    参数值类型的引用字符串，用于写入清单缓存
+
+    :param value_type: 类型或转换函数，或已是引用字符串
+    :return: module:qualname 格式的字符串，为空时返回空；无法通过名称引用（如 lambda、局部函数）时抛出 ValueError
+    """
+    if value_type is None or isinstance(value_type, str):
+        return value_type
+    module = getattr(value_type, '__module__', None)
+    qualname = getattr(value_type, '__qualname__', None)
+    if not module or not qualname or '<' in qualname:
+        raise ValueError('Value type can not be referenced by name: %r' % (value_type,))
+    return '%s:%s' % (module, qualname)
+
+
+def resolve_type(value_type):
+    """
+    解析参数值类型，引用字符串在此时才加载所在的模块
+
+    :param value_type: 类型、转换函数或 module:qualname 格式的引用字符串
+    :return: 可调用对象，为空时返回空
+    """
+    if not isinstance(value_type, str):
+        return value_type
+    module_name, _, qualname = value_type.partition(':')
+    obj = importlib.import_module(module_name)
+    for attr in qualname.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+
+class CmdParser(object):
+    """
+    编译后的子命令参数解析器。参数对象在创建时编译为参数名到参数对象的查找表，之后每次解析只需一次遍历。
+    支持与 getopt 相同的写法（-s、-abc、-pVALUE、-p VALUE、--long、--long=VALUE、--long VALUE、长参名的唯一前缀、-- 结束参数），
+    以及参数值的类型转换、可重复的参数，参数错误时抛出的异常中包含出错的参数名
+    """
+
+    def __init__(self, args):
+        """
+        编译解析器
+
+        :param args: 参数对象 CmdArg 的元组
+        """
+        self.__opts = {}    # key为短参名或长参名，value为参数对象，帮助参数的value为空
+        self.__long_names = []  # 全部长参名，用于解析长参名的前缀
+        self.__types = {}   # 参数值的转换函数，key为参数对象的id，在首次转换时解析
+        for opt in HELP_OPTS:
+            self.__opts[opt] = None
+        for arg in args:
+            if arg.short_name:
+                self.__opts[arg.short_name] = arg
+            if arg.long_name:
+                self.__opts[arg.long_name] = arg
+        self.__long_names = sorted(opt for opt in self.__opts if opt.startswith('--'))
+
+    def __long_opt(self, name):
+        """
+        查找长参名，接受唯一的前缀
+
+        :param name: 命令行中的长参名，不含 =VALUE
+        :return: 完整的长参名
+        """
+        if name in self.__opts:
+            return name
+        matches = [opt for opt in self.__long_names if opt.startswith(name)]
+        if len(matches) == 1:
+            return matches[0]
+        if not matches:
+            raise InvalidParameterError('Unknown option: %s' % name)
+        raise InvalidParameterError('Ambiguous option: %s (%s)' % (name, ', '.join(matches)))
+
+    def __convert(self, opt, arg: CmdArg, value):
+        if arg is None or arg.value_type is None:
+            return value
+        converter = self.__types.get(id(arg))
+        if converter is None:
+            converter = resolve_type(arg.value_type)
+            self.__types[id(arg)] = converter
+        try:
+            return converter(value)
+        except (TypeError, ValueError) as e:
+            raise InvalidParameterError('Invalid value for %s: %r (%s)' % (opt, value, e))
+
+    def parse(self, argv):
+        """
+        解析命令行参数，遇到第一个非参数的值时结束
+
+        :param argv: 子命令之后的命令行参数
+        :return: ((参数名, 参数值) 的列表, 剩余的参数列表)。不需要参数值的参数，参数值为空字符串；
+                 可重复的参数只出现一次，参数值为全部值的列表，位置为第一次出现的位置
+        :raise InvalidParameterError: 未知的参数、不唯一的长参名前缀、无法转换的参数值、不可重复的参数出现多次
+        :raise InsufficientParametersError: 需要参数值的参数缺少参数值
+        """
+        opts = []
+        positions = {}  # 已出现的参数，key为参数对象的id，value为在 opts 中的位置
+        i = 0
+        while i < len(argv):
+            token = argv[i]
+            i += 1
+            if token == '--':
+                break
+            if not token.startswith('-') or token == '-':
+                i -= 1
+                break
+            if token.startswith('--'):
+                name, has_value, value = token.partition('=')
+                opt = self.__long_opt(name)
+                pending = [(opt, value if has_value else None, has_value)]
+            else:
+                pending = []
+                j = 1
+                while j < len(token):
+                    opt = '-' + token[j]
+                    if opt not in self.__opts:
+                        raise InvalidParameterError('Unknown option: %s' % opt)
+                    arg = self.__opts[opt]
+                    if arg is not None and arg.need_value:
+                        rest = token[j + 1:]
+                        pending.append((opt, rest if rest else None, bool(rest)))
+                        break
+                    pending.append((opt, None, False))
+                    j += 1
+
+            for opt, value, has_value in pending:
+                arg = self.__opts[opt]
+                if arg is not None and arg.need_value:
+                    if not has_value:
+                        if i >= len(argv):
+                            raise InsufficientParametersError('Option %s requires a value' % opt)
+                        value = argv[i]
+                        i += 1
+                    value = self.__convert(opt, arg, value)
+                else:
+                    if has_value:
+                        raise InvalidParameterError('Option %s does not take a value' % opt)
+                    value = ''
+                if arg is None:
+                    opts.append((opt, value))
+                    continue
+                pos = positions.get(id(arg))
+                if pos is None:
+                    positions[id(arg)] = len(opts)
+                    opts.append((opt, [value] if arg.repeatable else value))
+                elif arg.repeatable:
+                    opts[pos][1].append(value)
+                else:
+                    raise InvalidParameterError('Option %s can not be given more than once' % opt)
+        return opts, argv[i:]
@@ -0,0 +1,319 @@
+# -*- coding: UTF-8 -*-
+import multiprocessing
+import os
+import pickle
+import queue
+import signal
+import sys
+import threading
+import traceback
+from multiprocessing import reduction
+from multiprocessing.connection import Connection
+
+from util import CmdHelper, CommandException, CommandTimeoutError, WorkerDiedError
+from util.cmd_helper import DefaultCmdHelper
+from util.cmd_loader import CmdLoader
+
+STATUS_OK = 'ok'
+STATUS_ERROR = 'error'
+SPAWN = 'spawn'
+REAP = 'reap'
+CLOSE_TIMEOUT = 1.0     # 关闭时等待工作进程退出的秒数，超时后杀死
+
+
+class _RemoteTraceback(Exception):
+    """
+    工作进程中异常的堆栈，作为传回的异常的 __cause__，使打印的堆栈包含子命令中出错的位置
+    """
+
+    def __init__(self, tb):
+        super().__init__(tb)
+        self.tb = tb
+
+    def __str__(self):
+        return self.tb
+
+
+def _picklable(obj):
+    try:
+        pickle.dumps(obj)
+        return True
+    except Exception:
+        return False
+
+
+def _worker_main(conn, helper):
+    """
+    工作进程的主循环：接收 (子命令名, 参数名, 参数值)，使用继承自父进程的 helper 执行，返回 (状态, 返回值或异常, 堆栈)
+    """
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            return
+        if request is None:
+            return
+        sub_cmd, opt, value = request
+        try:
+            reply = (STATUS_OK, helper.execute(sub_cmd, opt, value), None)
+            if not _picklable(reply[1]):
+                reply = (STATUS_ERROR, CommandException('Unpicklable result: %r' % (reply[1],)), None)
+        except BaseException as e:
+            tb = traceback.format_exc()
+            if not _picklable(e):
+                e = CommandException('%s: %s' % (type(e).__name__, e))
+            reply = (STATUS_ERROR, e, tb)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        conn.send(reply)
+
+
+def _fork_worker(conn, helper):
+    """
+    在孵化进程中 fork 一个工作进程，将进程号与同工作进程通信的套接字传回调用方
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    parent_conn, child_conn = multiprocessing.Pipe()
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            conn.close()
+            parent_conn.close()
+            _worker_main(child_conn, helper)
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+    child_conn.close()
+    conn.send(pid)
+    reduction.send_handle(conn, parent_conn.fileno(), None)
+    parent_conn.close()
+
+
+def _spawner_main(conn, helper):
+    """
+    孵化进程的主循环。孵化进程只有一个线程，工作进程都由它 fork 得到，
+    调用方即使已启动了其他线程，也不会在持有锁的线程之外 fork，避免工作进程中的死锁。
+    请求为 (SPAWN, None) 时创建工作进程，为 (REAP, 进程号) 时等待工作进程退出并返回退出码。
+    孵化进程忽略 SIGINT，终端中的 Ctrl-C 只中断调用方与工作进程
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            return
+        if request is None:
+            return
+        action, pid = request
+        if action == SPAWN:
+            _fork_worker(conn, helper)
+        elif action == REAP:
+            _, status = os.waitpid(pid, 0)
+            conn.send(os.waitstatus_to_exitcode(status))
+
+
+class _Worker(object):
+    """
+    一个工作进程及与其通信的管道
+    """
+
+    def __init__(self, pid, conn):
+        self.pid = pid
+        self.conn = conn
+        self.exitcode = None    # 工作进程被回收后的退出码
+
+
+class CmdWorkerPool(object):
+    """
+    工作进程池，在独立的进程中执行子命令的参数，子命令崩溃、卡死或耗尽 CPU 时不影响调用方，且可利用多核。
+    start 在子命令加载和组装完成后 fork 一个孵化进程，工作进程均由孵化进程 fork 得到，继承已加载的模块，执行时无需再次加载。
+    超时的调用会杀死工作进程，意外退出的工作进程会被重新创建；重新创建同样由单线程的孵化进程完成，
+    不会从调用方的多个线程中 fork。start 应在调用方启动其他线程之前调用。
+    通过 DefaultCmdHelper.set_executor 启用后，run、run_all 及批量执行均在工作进程中执行参数
+    """
+
+    def __init__(self, loader: CmdLoader, helper: CmdHelper = None, workers=None, timeout=None):
+        """
+        创建工作进程池
+
+        :param loader: 子命令加载器
+        :param helper: 用户生成，为空时使用 DefaultCmdHelper，工作进程使用其 execute 执行参数
+        :param workers: 工作进程数，为空时为 CPU 核数
+        :param timeout: 每次调用的默认超时秒数，为空时不限时
+        """
+        self.__loader = loader
+        self.__helper = helper if helper is not None else DefaultCmdHelper()
+        self.__workers = workers if workers else (os.cpu_count() or 1)
+        self.__timeout = timeout
+        self.__context = multiprocessing.get_context('fork')
+        self.__spawner = None   # 孵化进程
+        self.__spawner_conn = None  # 与孵化进程通信的管道
+        self.__idle = queue.Queue()  # 空闲的工作进程，关闭后放入 None 唤醒等待的调用方
+        self.__all = set()  # 全部工作进程
+        self.__lock = threading.Lock()  # 保护 __all 以及与孵化进程的通信
+        self.__closed = False
+
+    def __spawn(self):
+        """
+        由孵化进程 fork 一个新的工作进程
+        """
+        with self.__lock:
+            self.__spawner_conn.send((SPAWN, None))
+            pid = self.__spawner_conn.recv()
+            worker = _Worker(pid, Connection(reduction.recv_handle(self.__spawner_conn)))
+            self.__all.add(worker)
+        return worker
+
+    def __kill(self, worker):
+        """
+        杀死工作进程并由孵化进程回收，调用方须持有 __lock
+        """
+        worker.conn.close()
+        try:
+            os.kill(worker.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.__spawner_conn.send((REAP, worker.pid))
+        worker.exitcode = self.__spawner_conn.recv()
+
+    def __discard(self, worker):
+        with self.__lock:
+            self.__all.discard(worker)
+            self.__kill(worker)
+
+    def __replace(self, worker):
+        """
+        杀死超时或已退出的工作进程，并创建新的工作进程放回空闲队列。孵化进程已退出而无法创建时关闭工作进程池
+
+        :return: 被杀死的工作进程的退出码，无法回收时为空
+        """
+        try:
+            self.__discard(worker)
+            if not self.__closed:
+                self.__idle.put(self.__spawn())
+                return worker.exitcode
+        except (EOFError, OSError):
+            pass
+        self.close()
+        return worker.exitcode
+
+    def start(self):
+        """
+        加载并组装子命令，预先加载全部子命令模块，然后启动孵化进程与工作进程
+
+        :return: 当前对象，允许链式调用
+        """
+        self.__helper.set_cmd_loader(self.__loader)
+        self.__helper.assemble()
+        self.__loader.cmd_instances()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.__spawner_conn, child_conn = self.__context.Pipe()
+        self.__spawner = self.__context.Process(target=_spawner_main, args=(child_conn, self.__helper), daemon=True)
+        self.__spawner.start()
+        child_conn.close()
+        for _ in range(self.__workers):
+            self.__idle.put(self.__spawn())
+        return self
+
+    def helper(self):
+        """
+        获取工作进程使用的 helper
+
+        :return: CmdHelper
+        """
+        return self.__helper
+
+    def execute(self, sub_cmd, opt, value, timeout=None):
+        """
+        在工作进程中运行子命令中的一个参数，没有空闲的工作进程时等待
+
+        :param sub_cmd: 子命令名
+        :param opt: 参数名，传入的可能是短参名也可能是长参名
+        :param value: 参数值
+        :param timeout: 超时秒数，为空时使用创建时指定的超时
+        :return: 处理函数或 exec 的返回值，抛出的异常原样抛出
+        :raise CommandTimeoutError: 超时，执行的工作进程被杀死并重新创建
+        :raise WorkerDiedError: 工作进程意外退出，如子命令中调用了 os._exit 或进程崩溃
+        :raise CommandException: 工作进程池已关闭，包括等待空闲的工作进程时被关闭
+        """
+        if timeout is None:
+            timeout = self.__timeout
+        worker = self.__idle.get()
+        if worker is None or self.__closed:
+            # 唤醒下一个等待的调用方
+            self.__idle.put(None)
+            raise CommandException('Worker pool is closed')
+        try:
+            worker.conn.send((sub_cmd, opt, value))
+            if not worker.conn.poll(timeout):
+                self.__replace(worker)
+                raise CommandTimeoutError('Command timed out after %ss: %s %s' % (timeout, sub_cmd, opt))
+            status, result, tb = worker.conn.recv()
+        except (EOFError, OSError):
+            if self.__closed:
+                raise CommandException('Worker pool is closed') from None
+            code = self.__replace(worker)
+            raise WorkerDiedError('Worker died (exit code %s): %s %s' % (code, sub_cmd, opt)) from None
+        except CommandTimeoutError:
+            raise
+        except BaseException:
+            # 如 KeyboardInterrupt，工作进程仍在执行被放弃的调用，不能放回空闲队列
+            self.__replace(worker)
+            raise
+        self.__idle.put(worker)
+        if status == STATUS_ERROR:
+            if tb:
+                result.__cause__ = _RemoteTraceback(tb)
+            raise result
+        return result
+
+    def close(self):
+        """
+        停止全部工作进程，等待空闲工作进程的调用方抛出 CommandException。可重复调用
+        """
+        self.__closed = True
+        self.__idle.put(None)
+        with self.__lock:
+            spawner, self.__spawner = self.__spawner, None
+            if spawner is None:
+                return
+            workers = list(self.__all)
+            self.__all.clear()
+            for worker in workers:
+                try:
+                    worker.conn.send(None)
+                except OSError:
+                    pass
+            for worker in workers:
+                # 工作进程退出后管道关闭，poll 立即返回
+                try:
+                    worker.conn.poll(CLOSE_TIMEOUT)
+                except OSError:
+                    pass
+                try:
+                    self.__kill(worker)
+                except (EOFError, OSError):
+                    pass
+            try:
+                self.__spawner_conn.send(None)
+            except OSError:
+                pass
+            self.__spawner_conn.close()
+        spawner.join(CLOSE_TIMEOUT)
+        if spawner.is_alive():
+            spawner.kill()
+            spawner.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
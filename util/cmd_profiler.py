@@ -0,0 +1,96 @@
+# -*- coding: UTF-8 -*-
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+REPORT_PHASE_FMT = "{0:<14}{1:>8}{2:>12}"
+REPORT_MODULE_FMT = "{0:<40}{1:>12}"
+
+
+class NullProfiler(object):
+    """
+    空的性能分析器，未设置分析器时使用，不记录任何数据
+    """
+
+    def phase(self, phase, target=''):
+        return nullcontext()
+
+
+class CmdProfiler(object):
+    """
+    性能分析器，记录加载和运行子命令时各阶段的耗时。
+    阶段包括 scan（扫描目录）、manifest（读写清单缓存）、import（加载模块）、instantiate（创建实例）、
+    assemble（组装）、parse（解析参数）、exec（执行参数），阶段之间可能嵌套，如 assemble 中包含 scan
+    """
+
+    def __init__(self):
+        self.__events = []  # 阶段耗时，元素为 (阶段名, 目标, 耗时秒数)
+        self.__listeners = []
+        self.__lock = threading.Lock()
+
+    def add_listener(self, listener):
+        """
+        添加阶段结束时的回调，可用于将耗时发送到自己的日志系统
+
+        :param listener: 回调函数，参数为 (阶段名, 目标, 耗时秒数)，目标为模块名、子命令名等，可能为空字符串
+        :return: 当前对象，允许链式调用
+        """
+        self.__listeners.append(listener)
+        return self
+
+    @contextmanager
+    def phase(self, phase, target=''):
+        """
+        记录一个阶段的耗时，用于 with 语句
+
+        :param phase: 阶段名
+        :param target: 阶段的目标，如模块名、子命令名
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.__lock:
+                self.__events.append((phase, target, elapsed))
+            for listener in self.__listeners:
+                listener(phase, target, elapsed)
+
+    def events(self):
+        """
+        获取已记录的阶段耗时
+
+        :return: (阶段名, 目标, 耗时秒数) 的列表，按阶段结束的顺序
+        """
+        with self.__lock:
+            return list(self.__events)
+
+    def report(self, top=5):
+        """
+        生成耗时报表，包括每个阶段的次数与总耗时，以及加载最慢的模块
+
+        :param top: 列出加载最慢的模块的个数
+        :return: 报表文本
+        """
+        events = self.events()
+        phases = {}
+        imports = []
+        for phase, target, elapsed in events:
+            count, total = phases.get(phase, (0, 0.0))
+            phases[phase] = (count + 1, total + elapsed)
+            if phase == 'import':
+                imports.append((elapsed, target))
+
+        lines = [REPORT_PHASE_FMT.format('phase', 'count', 'total(ms)')]
+        for phase, (count, total) in phases.items():
+            lines.append(REPORT_PHASE_FMT.format(phase, count, '%.3f' % (total * 1000)))
+        if imports:
+            imports.sort(reverse=True)
+            lines.append('')
+            lines.append(REPORT_MODULE_FMT.format('slowest imports', 'time(ms)'))
+            for elapsed, target in imports[:top]:
+                lines.append(REPORT_MODULE_FMT.format(target, '%.3f' % (elapsed * 1000)))
+        return '\n'.join(lines)
+
+
+NULL_PROFILER = NullProfiler()
@@ -0,0 +1,129 @@
+# -*- coding: UTF-8 -*-
+import os
+import py_compile
+import shutil
+import tempfile
+import zipapp
+
+from command import CmdArg
+from util.cmd_loader import ModuleFileCmdLoader
+from util.cmd_parser import type_ref
+
+REGISTRY_MODULE = '_registry'
+DEFAULT_PACKAGES = ('command', 'util')
+DEFAULT_INTERPRETER = '/usr/bin/env python3'
+
+REGISTRY_HEAD = '''# -*- coding: UTF-8 -*-
+# 由 util.cmd_registry 生成的子命令注册表，请勿修改。元素为 (子命令名, 模块的完整名称, 类名, 参数对象元组)
+from command import CmdArg
+
+COMMANDS = (
+'''
+
+
+def _arg_source(arg: CmdArg):
+    """
+    参数对象的构造代码。handler 为可调用对象时不写入，运行时由子命令实例提供；参数值类型以引用字符串写入
+    """
+    handler = arg.handler if isinstance(arg.handler, str) else None
+    return ('CmdArg(%r, %r, %r, %r, handler=%r, concurrent=%r, coalesce=%r, cache_ttl=%r, value_type=%r, '
+            'repeatable=%r)' % (arg.short_name, arg.long_name, arg.need_value, arg.description, handler,
+                                arg.concurrent, arg.coalesce, arg.cache_ttl, type_ref(arg.value_type),
+                                arg.repeatable))
+
+
+def registry_source(entries):
+    """
+    生成注册表模块的源代码
+
+    :param entries: (子命令名, 模块的完整名称, 类名, 参数对象元组) 的列表，参考 ModuleFileCmdLoader.cmd_modules
+    :return: 源代码
+    :raise ValueError: 参数值类型无法通过名称引用（如 lambda、局部函数），异常信息中包含子命令名与参数名
+    """
+    lines = [REGISTRY_HEAD]
+    for name, cmd_module, class_name, args in entries:
+        lines.append('    (%r, %r, %r, (\n' % (name, cmd_module, class_name))
+        for arg in args:
+            try:
+                lines.append('        %s,\n' % _arg_source(arg))
+            except ValueError as e:
+                raise ValueError('%s %s: %s, use a module level function or class instead'
+                                 % (name, arg.long_name or arg.short_name, e)) from None
+        lines.append('    )),\n')
+    lines.append(')\n')
+    return ''.join(lines)
+
+
+def write_registry(loader: ModuleFileCmdLoader, registry_file):
+    """
+    加载全部子命令并生成注册表模块
+
+    :param loader: 子命令加载器
+    :param registry_file: 注册表模块的文件路径
+    :return: 子命令个数
+    :raise ValueError: 参数值类型无法通过名称引用，参考 registry_source
+    """
+    loader.load()
+    entries = loader.cmd_modules()
+    source = registry_source(entries)
+    with open(registry_file, 'w', encoding='utf-8') as f:
+        f.write(source)
+    return len(entries)
+
+
+def _copy_package(project_dir, package, stage_dir):
+    """
+    复制包中的py文件，忽略 __pycache__ 以及以 . 开头的文件和目录
+    """
+    for root, dirs, files in os.walk(os.path.join(project_dir, package)):
+        dirs[:] = [d for d in dirs if d != '__pycache__' and not d.startswith('.')]
+        target_dir = os.path.join(stage_dir, os.path.relpath(root, project_dir))
+        os.makedirs(target_dir, exist_ok=True)
+        for f in files:
+            if f.endswith('.py') and not f.startswith('.'):
+                shutil.copy2(os.path.join(root, f), os.path.join(target_dir, f))
+
+
+def _compile_tree(stage_dir):
+    """
+    将py文件编译为与源文件同目录的 .pyc。zipimport 不读取 __pycache__，只读取同目录的 .pyc；
+    使用不检查的哈希校验，运行时无需比较源文件的修改时间
+    """
+    for root, _, files in os.walk(stage_dir):
+        for f in files:
+            if f.endswith('.py') and not (root == stage_dir and f == '__main__.py'):
+                source = os.path.join(root, f)
+                py_compile.compile(source, cfile=source + 'c', doraise=True,
+                                   invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+
+
+def build_zipapp(output, project_dir, loader: ModuleFileCmdLoader, main_file='cmd.py', packages=DEFAULT_PACKAGES,
+                 interpreter=DEFAULT_INTERPRETER):
+    """
+    打包为单个 zipapp 文件：复制入口与各个包，在 command 包中生成注册表模块 _registry，并预先编译字节码。
+    源代码目录不会被修改，注册表只存在于打包结果中
+
+    :param output: 输出的 .pyz 文件路径
+    :param project_dir: 项目目录，即入口与各个包所在的目录
+    :param loader: 源代码目录中的子命令加载器
+    :param main_file: 入口文件，打包为 __main__.py
+    :param packages: 打包的包名
+    :param interpreter: 写入 shebang 的解释器，为空时不写入
+    :return: 子命令个数
+    :raise ValueError: 参数值类型无法通过名称引用，参考 registry_source，此时不会生成任何文件
+    """
+    loader.load()
+    entries = loader.cmd_modules()
+    source = registry_source(entries)
+    stage_dir = tempfile.mkdtemp(prefix='cmd_zipapp_')
+    try:
+        shutil.copy2(os.path.join(project_dir, main_file), os.path.join(stage_dir, '__main__.py'))
+        for package in packages:
+            _copy_package(project_dir, package, stage_dir)
+        with open(os.path.join(stage_dir, 'command', REGISTRY_MODULE + '.py'), 'w', encoding='utf-8') as f:
+            f.write(source)
+        _compile_tree(stage_dir)
+        zipapp.create_archive(stage_dir, output, interpreter=interpreter)
+    finally:
+        shutil.rmtree(stage_dir, ignore_errors=True)
+    return len(entries)
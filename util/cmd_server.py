@@ -0,0 +1,151 @@
+# -*- coding: UTF-8 -*-
+import json
+import os
+import socket
+import socketserver
+import struct
+import sys
+import traceback
+
+from util import CmdHelper
+from util.cmd_client import HEADER_FMT, EXIT_CODE_FMT, default_socket_path, is_trusted_peer, recv_exactly
+from util.cmd_helper import DefaultCmdHelper, dispatch_cmd
+from util.cmd_loader import CmdLoader
+
+
+class _CmdRequestHandler(socketserver.BaseRequestHandler):
+    """
+    处理一次客户端调用。该处理在守护进程 fork 出的子进程中运行，
+    将客户端传来的标准输入、输出、错误替换为子进程的 0、1、2，并切换到客户端的工作目录和环境变量后执行子命令
+    """
+
+    def handle(self):
+        # 只接受当前用户的调用；平台不支持 SO_PEERCRED 时依靠套接字文件的 0600 权限
+        if not is_trusted_peer(self.request, self.server.server_address):
+            return
+        header_size = struct.calcsize(HEADER_FMT)
+        header, fds, _, _ = socket.recv_fds(self.request, header_size, 3)
+        if len(header) != header_size or len(fds) != 3:
+            return
+        payload = recv_exactly(self.request, struct.unpack(HEADER_FMT, header)[0])
+        if payload is None:
+            return
+        request = json.loads(payload.decode('utf-8'))
+
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        os.environ.clear()
+        os.environ.update(request['env'])
+        try:
+            os.chdir(request['cwd'])
+        except OSError:
+            pass
+
+        try:
+            code = dispatch_cmd(request['argv'], self.server.cmd_helper)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        # 子进程以 os._exit 退出，不会执行 atexit 中的写入，执行指标在此写入文件
+        metrics = self.server.cmd_helper.metrics()
+        if metrics is not None:
+            try:
+                metrics.flush()
+            except OSError:
+                traceback.print_exc()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.request.sendall(struct.pack(EXIT_CODE_FMT, code or 0))
+
+
+class _ForkingUnixServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    pass
+
+
+class CmdServer(object):
+    """
+    常驻的守护进程，只加载和组装一次子命令，通过 Unix 套接字接收 util.cmd_client 转发的调用。
+    每次调用在 fork 出的子进程中执行，继承已加载的模块和组装好的帮助，且调用之间互不影响
+    """
+
+    def __init__(self, loader: CmdLoader, helper: CmdHelper = None, socket_path=None):
+        """
+        创建守护进程
+
+        :param loader: 子命令加载器
+        :param helper: 用户生成，为空时使用 DefaultCmdHelper
+        :param socket_path: 套接字路径，为空时使用 default_socket_path()，即 scope 为空；cmd.py 以命令目录作为 scope
+        """
+        self.__loader = loader
+        self.__helper = helper if helper is not None else DefaultCmdHelper()
+        self.__socket_path = socket_path if socket_path else default_socket_path()
+        self.__server = None
+
+    def __remove_stale_socket(self):
+        """
+        删除残留的套接字文件，若已有守护进程在监听则抛出异常
+        """
+        if not os.path.exists(self.__socket_path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.__socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.remove(self.__socket_path)
+            return
+        finally:
+            probe.close()
+        raise OSError('Command server is already running on %s' % self.__socket_path)
+
+    def start(self):
+        """
+        加载并组装子命令，预先加载全部子命令模块，然后开始监听套接字
+
+        :return: 当前对象，允许链式调用
+        """
+        self.__helper.set_cmd_loader(self.__loader)
+        self.__helper.assemble()
+        self.__loader.cmd_instances()
+        self.__remove_stale_socket()
+        old_umask = os.umask(0o077)
+        try:
+            self.__server = _ForkingUnixServer(self.__socket_path, _CmdRequestHandler)
+        finally:
+            os.umask(old_umask)
+        self.__server.cmd_helper = self.__helper
+        return self
+
+    def serve_forever(self):
+        """
+        处理调用直到 shutdown 被调用或进程被中断，退出时删除套接字文件
+        """
+        if self.__server is None:
+            self.start()
+        try:
+            self.__server.serve_forever()
+        finally:
+            self.__server.server_close()
+            try:
+                os.remove(self.__socket_path)
+            except OSError:
+                pass
+
+    def reload(self):
+        """
+        增量重新加载子命令，此后的调用使用新的子命令，可在 SIGHUP 等信号的处理中调用
+
+        :return: (新增的子命令名, 修改的子命令名, 删除的子命令名)
+        """
+        changes = self.__helper.reload()
+        self.__loader.cmd_instances()
+        return changes
+
+    def shutdown(self):
+        """
+        停止处理调用，需要在 serve_forever 以外的线程中调用
+        """
+        if self.__server is not None:
+            self.__server.shutdown()
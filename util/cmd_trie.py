@@ -0,0 +1,149 @@
+# -*- coding: UTF-8 -*-
+
+DEFAULT_MAX_DISTANCE = 2
+DEFAULT_SUGGESTIONS = 5
+
+
+class _TrieNode(object):
+    __slots__ = ('children', 'word', 'count')
+
+    def __init__(self):
+        self.children = {}  # key为字符，value为子节点
+        self.word = None    # 以该节点结尾的子命令名
+        self.count = 0      # 该节点下（含自身）的子命令个数
+
+
+class CmdTrie(object):
+    """
+    子命令名的前缀树，用于唯一前缀的缩写解析（如 net 解析为 network），
+    以及在前缀树上以有界编辑距离搜索相近的子命令名。查找沿前缀树进行，不逐个扫描全部子命令名
+    """
+
+    def __init__(self, names=()):
+        """
+        创建前缀树
+
+        :param names: 初始的子命令名
+        """
+        self.__root = _TrieNode()
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return self.__root.count
+
+    def __find(self, prefix):
+        node = self.__root
+        for c in prefix:
+            node = node.children.get(c)
+            if node is None:
+                return None
+        return node
+
+    def add(self, name):
+        """
+        添加子命令名，已存在时忽略
+
+        :param name: 子命令名
+        :return: 当前对象，允许链式调用
+        """
+        if not name:
+            return self
+        existing = self.__find(name)
+        if existing is not None and existing.word is not None:
+            return self
+        node = self.__root
+        node.count += 1
+        for c in name:
+            node = node.children.setdefault(c, _TrieNode())
+            node.count += 1
+        node.word = name
+        return self
+
+    def remove(self, name):
+        """
+        删除子命令名，不存在时忽略
+
+        :param name: 子命令名
+        :return: 当前对象，允许链式调用
+        """
+        node = self.__find(name) if name else None
+        if node is None or node.word is None:
+            return self
+        node = self.__root
+        node.count -= 1
+        for c in name:
+            child = node.children[c]
+            child.count -= 1
+            if child.count == 0:
+                del node.children[c]
+                return self
+            node = child
+        node.word = None
+        return self
+
+    def resolve(self, prefix):
+        """
+        解析子命令名或其唯一前缀
+
+        :param prefix: 完整的子命令名或前缀
+        :return: 完全匹配的子命令名；否则以 prefix 开头的子命令只有一个时返回该子命令名；不存在或不唯一时返回空
+        """
+        node = self.__find(prefix) if prefix else None
+        if node is None:
+            return None
+        if node.word is not None:
+            return node.word
+        if node.count != 1:
+            return None
+        while node.word is None:
+            node = next(iter(node.children.values()))
+        return node.word
+
+    def starts_with(self, prefix, limit=None):
+        """
+        以 prefix 开头的子命令名
+
+        :param prefix: 前缀
+        :param limit: 最多返回的个数，为空时不限
+        :return: 子命令名的列表，按名称排序
+        """
+        node = self.__find(prefix)
+        if node is None:
+            return []
+        names = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.word is not None:
+                names.append(node.word)
+            stack.extend(node.children.values())
+        names.sort()
+        return names[:limit] if limit else names
+
+    def suggest(self, word, max_distance=DEFAULT_MAX_DISTANCE, limit=DEFAULT_SUGGESTIONS):
+        """
+        查找与 word 的编辑距离（Levenshtein）不超过 max_distance 的子命令名。
+        在前缀树上逐层计算编辑距离矩阵的一行，一行中的最小值超过 max_distance 时剪去整棵子树，
+        公共前缀的计算结果被共享，因此只访问距离可能在范围内的节点
+
+        :param word: 未知的子命令名
+        :param max_distance: 最大编辑距离
+        :param limit: 最多返回的个数
+        :return: 子命令名的列表，按编辑距离、名称排序
+        """
+        found = []
+        first_row = list(range(len(word) + 1))
+        stack = [(child, c, first_row) for c, child in self.__root.children.items()]
+        while stack:
+            node, c, prev_row = stack.pop()
+            row = [prev_row[0] + 1]
+            for i in range(1, len(word) + 1):
+                cost = 0 if word[i - 1] == c else 1
+                row.append(min(row[i - 1] + 1, prev_row[i] + 1, prev_row[i - 1] + cost))
+            if node.word is not None and row[-1] <= max_distance:
+                found.append((row[-1], node.word))
+            if min(row) <= max_distance:
+                stack.extend((child, cc, row) for cc, child in node.children.items())
+        found.sort()
+        return [name for _, name in found[:limit]]